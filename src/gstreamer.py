@@ -7,8 +7,10 @@ from datetime import datetime
 import logging
 import os
 import threading
+import time
 
 import gi
+import numpy as np
 
 SOCKET_PATH = '/tmp/foo'
 SINK_NAME = 'pipesink'
@@ -227,6 +229,21 @@ class SHMSrc(PipelinePart):
             '{caps} ! videoconvert ! appsink'
         ).format(**dict(merge_defaults(kwargs), caps=caps)))
 
+class AppSink(PipelinePart):
+    """
+    A GStreamer pipeline part that takes in raw video, converts it to
+    BGR if it isn't already and hands it to an AppSinkCapture in the
+    same process, without going through a shared memory location.
+
+    Only the newest frame is kept, so frames that aren't pulled in time
+    are dropped instead of queueing up.
+    """
+    def __new__(cls, **kwargs):
+        return super().__new__(cls, (
+            'videoconvert ! video/x-raw, format=BGR ! '
+            'appsink name={sink_name} max-buffers=1 drop=true sync=false'
+        ).format(**merge_defaults(kwargs)))
+
 class Valve(PipelinePart):
     """
     Represents a valve element for GStreamer.
@@ -333,9 +350,110 @@ def print_message(message):
         m_type = message.type
         logger.error('Unexpected message of type {} received.'.format(m_type))
 
+class MappedFrame(object):
+    """
+    A frame pulled from an appsink. Its image is a read-only NumPy array
+    that uses the memory of the GStreamer buffer itself, rather than a
+    copy of it.
+
+    The image can only be used while the buffer is mapped, so frames
+    should be used as context managers, which unmap them on exit:
+
+    >>> with capture.pull() as frame:
+    ...     process(frame.image)
+    """
+
+    def __init__(self, sample, timestamp):
+        struct = sample.get_caps().get_structure(0)
+        width = struct.get_value('width')
+        height = struct.get_value('height')
+
+        self.buffer = sample.get_buffer()
+        self.pts = self.buffer.pts # In nanoseconds, or Gst.CLOCK_TIME_NONE
+        self.timestamp = timestamp # time.monotonic() time it was captured at
+        mapped, self._info = self.buffer.map(Gst.MapFlags.READ)
+        if not mapped:
+            raise RuntimeError('Could not map buffer')
+
+        # Rows may be padded (e.g. to a multiple of 4 bytes)
+        stride = self._info.size // height
+        self.image = np.ndarray((height, width, 3), np.uint8, self._info.data,
+                                strides=(stride, 3, 1))
+
+    def unmap(self):
+        """Release the buffer. The image can't be used after this."""
+        if self.image is not None:
+            self.image = None
+            self.buffer.unmap(self._info)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.unmap()
+
+class AppSinkCapture(object):
+    """
+    Reads frames from an AppSink in a pipeline, as a replacement for
+    reading them with cv2's VideoCapture from an SHMSink.
+
+    The pipeline should be playing before frames are pulled.
+
+    Since the appsink only keeps the latest frame, frames that arrive
+    faster than they are pulled are dropped. These are counted in
+    dropped, going by gaps in the buffers' offsets (which sources like
+    v4l2src and videotestsrc set to the frame number).
+    """
+
+    def __init__(self, pipe, sink_name=SINK_NAME):
+        self.pipeline = pipe
+        self.sink = pipe.get_by_name(sink_name)
+        self.pulled = 0 # Number of frames pulled
+        self.dropped = 0 # Number of frames dropped before they were pulled
+        self._last_offset = None # Offset of the last buffer pulled
+
+    def capture_time(self, pts):
+        """Return the time.monotonic() time a buffer with the given PTS was
+        captured at, or the current time if this isn't known.
+
+        This assumes the PTS is the running time of the pipeline when
+        the buffer was captured, which is true of live sources.
+        """
+        now = time.monotonic()
+        clock = self.pipeline.get_clock()
+        if pts == Gst.CLOCK_TIME_NONE or clock is None:
+            return now
+        running_time = clock.get_time() - self.pipeline.get_base_time()
+        return now - (running_time - pts) / Gst.SECOND
+
+    def pull(self, timeout=Gst.SECOND):
+        """Return the next frame as a MappedFrame, or None if there isn't
+        one within the timeout (in nanoseconds) or the stream has ended."""
+        sample = self.sink.emit('try-pull-sample', timeout)
+        if sample is None:
+            return None
+        buf = sample.get_buffer()
+        self.pulled += 1
+        if buf.offset == Gst.BUFFER_OFFSET_NONE:
+            self._last_offset = None
+        else:
+            if self._last_offset is not None and buf.offset > self._last_offset:
+                self.dropped += buf.offset - self._last_offset - 1
+            self._last_offset = buf.offset
+        return MappedFrame(sample, self.capture_time(buf.pts))
+
+    def read(self):
+        """Return a status and a copy of the next image, like cv2's
+        VideoCapture.read."""
+        frame = self.pull()
+        if frame is None:
+            return False, None
+        with frame:
+            return True, frame.image.copy()
+
 class MessagePrinter(threading.Thread):
     """Thread that continuously queries the pipeline's bus for messages,
-    printing them to stdout.
+    printing them to stdout and counting the errors in errors.
     """
     MESSAGE_TYPES = (Gst.MessageType.STATE_CHANGED | Gst.MessageType.ERROR |
                      Gst.MessageType.EOS)
@@ -344,6 +462,7 @@ class MessagePrinter(threading.Thread):
         threading.Thread.__init__(self)
         self._stop = threading.Event()
         self.pipeline = pipe
+        self.errors = 0 # Number of error messages received
 
     def run(self):
         """Start the thread."""
@@ -352,6 +471,8 @@ class MessagePrinter(threading.Thread):
              # In nanoseconds, so wait 0.1s = 1e5 nanoseconds
             message = bus.timed_pop_filtered(1e5, self.MESSAGE_TYPES)
             if message is not None:
+                if message.type == Gst.MessageType.ERROR:
+                    self.errors += 1
                 print_message(message)
 
     def stop(self):
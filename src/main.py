@@ -5,70 +5,140 @@ and sending results back to clients connected to a server.
 
 import logging
 import logging.config
-import threading
+import os
+import time
+from functools import partial
 import cv2
 import config
 import gstreamer as gs
 import networking
 import networking.messages as m
-from processing.tapecontours import get_corners_from_image
+from networking.metrics import METRICS, MetricsServer, add_frame_metrics
+from processing.parallel import ParallelProcessor, WORKERS
+from processing.profiling import LATENCY, PROFILER, LatencyTracker
+from processing.tracking import TapeTracker
 Gst = gs.Gst
 
+# If set, the timings of each processing stage are recorded and written
+# to this file when the program exits
+PROFILE_FILE = os.environ.get('VISION_PROFILE')
+# Stages timed in worker processes aren't seen by the profiler here, so
+# images are processed in this process while profiling
+PROCESS_WORKERS = 0 if PROFILE_FILE is not None else WORKERS
+
 if __name__ == '__main__':
     conf = config.configfor('Vision')
 
     logging.config.dictConfig(conf.logging)
     logger = logging.getLogger(__name__)
 
-
-    gs.delete_socket()
+    PROFILER.enabled = PROFILE_FILE is not None
 
     pipeline = gs.pipeline(
         gs.RaspiCam(**conf.params) +
         gs.Tee('t',
                gs.Valve('valve') + gs.H264Video() + gs.H264Stream(),
-               gs.SHMSink())
+               gs.AppSink())
     )
 
     pipeline.set_state(Gst.State.PLAYING)
 
-    # Start debugging the gstreamer pipeline
+    # Start debugging the gstreamer pipeline. The thread is kept running
+    # so that errors while processing are counted in the metrics.
     debuggingThread = gs.MessagePrinter(pipeline)
     debuggingThread.start()
 
     # TODO: Find a better method to wait for playback to start
     logger.debug(pipeline.get_state(Gst.CLOCK_TIME_NONE)) # Wait for pipeline to play
 
-    caps = gs.get_sink_caps(pipeline.get_by_name(gs.SINK_NAME))
-    cap_string = gs.make_command_line_parsable(caps)
-
-    cap = cv2.VideoCapture(gs.SHMSrc(cap_string))
-
-    # Now that the capture filters have been (hopefully) successfully
-    # captured, GStreamer doesn't need to be debugged anymore and the thread
-    # can be stopped.
-    debuggingThread.stop()
+    cap = gs.AppSinkCapture(pipeline)
 
     # Set up server
-    sock, clis = networking.server.create_socket_and_client_list(port=conf.controlport)
+    publisher = networking.udp.UDPPublisher()
     handler = networking.create_gst_handler(pipeline, gs.SRC_NAME, 'valve',
-                                            gs.UDP_NAME)
-
-    acceptThread = threading.Thread(target=networking.server.AcceptClients,
-                                    args=[sock, clis, handler])
-    acceptThread.daemon = True # Makes the thread quit with the current thread
-    acceptThread.start()
+                                            gs.UDP_NAME, PROFILER.stats,
+                                            LATENCY.stats, publisher,
+                                            METRICS.collect)
+    server = networking.aioserver.Server(handler, port=conf.controlport,
+                                         profiler=LATENCY)
+    server.start()
+
+    # Each worker tracks the tape with its own copy of the tracker. Since
+    # the tape barely moves between frames, seeing only every few frames
+    # is fine.
+    tracker = TapeTracker()
+    processor = None
+    latency = LatencyTracker(LATENCY)
+    policy = networking.policy.PublishPolicy()
+
+    def client_stats(field):
+        """Return a function returning a field of each client's stats,
+        keyed by its address."""
+        return lambda: {'{}:{}'.format(*conn.address[:2]): getattr(s, field)
+                        for conn, s in server.stats().items()}
+
+    processed, detected, processing_latency = add_frame_metrics(cap)
+    METRICS.counter('results_suppressed_total',
+                    'Results not sent because they had not changed',
+                    lambda: policy.suppressed)
+    METRICS.counter('client_sent_bytes_total', 'Bytes sent to each client',
+                    client_stats('sent'), 'client')
+    METRICS.counter('client_dropped_messages_total',
+                    'Messages dropped because a client fell behind',
+                    client_stats('dropped'), 'client')
+    METRICS.gauge('client_queue_depth', 'Messages waiting for each client',
+                  client_stats('queued'), 'client')
+    METRICS.counter('gstreamer_errors_total', 'Errors from the pipeline bus',
+                    lambda: debuggingThread.errors)
+    metrics_server = MetricsServer(METRICS)
+    metrics_server.start()
 
     while True:
-        _, img = cap.read()
-        cv2.imshow('original', img)
-        corners = get_corners_from_image(img, show_image=True)
-
-        # Send the coordinates to the roborio
-        corns = [[(int(a[0]), int(a[1])) for a in b] for b in corners]
-        message = m.create_message(m.TYPE_RESULTS, {m.FIELD_CORNERS: corns})
-        networking.server.broadcast(sock, clis, message)
+        frame = cap.pull()
+        if frame is None:
+            continue
+        with frame:
+            cv2.imshow('original', frame.image)
+            if processor is None:
+                processor = ParallelProcessor(
+                    partial(tracker.get_corners,
+                            show_image=PROCESS_WORKERS == 0),
+                    frame.image.shape, workers=PROCESS_WORKERS)
+            # submit can block until a worker is free (or, without workers,
+            # until the frame is processed), which is part of processing
+            pulled = time.monotonic()
+            seq = processor.submit(frame.image)
+            latency.start(seq, frame.timestamp)
+            latency.mark(seq, 'capture', pulled)
+
+        for seq, corners in processor.ready():
+            latency.mark(seq, 'processing')
+            processing_latency.observe(latency.age(seq))
+            processed.inc()
+            if corners: # None if the worker failed, [] if not found
+                detected.inc()
+            # Results with no corners are still sent when the target is
+            # lost, so that the roborio stops using the last ones it got
+            if corners is None or not policy.should_publish(corners):
+                latency.finish(seq, record=False)
+                continue
+            # Send the coordinates to the roborio
+            fields = {
+                m.FIELD_TIMESTAMP: latency.timestamp(seq),
+                m.FIELD_LATENCY: latency.age(seq) * 1000
+            }
+            levels = networking.results.create_levels(corners)
+            networking.results.send_results(seq, fields, levels, server,
+                                            publisher)
+            latency.mark(seq, 'serialize')
+            latency.finish(seq)
 
         if cv2.waitKey(1) == ord('q'):
-            sock.close()
+            server.stop()
+            metrics_server.stop()
+            debuggingThread.stop()
+            publisher.close()
+            processor.close()
+            if PROFILE_FILE is not None:
+                PROFILER.dump(PROFILE_FILE)
             break
@@ -11,13 +11,15 @@ import numpy as np
 import config
 import networking
 import networking.messages as m
+from processing.stereocapture import StereoCapture
 from processing.tapecontours import get_corners_from_image
+from processing.videocapture import VideoCapture
 # Gst = gs.Gst
 
 if __name__ == '__main__':
     conf = config.configfor('Vision')
-    cleft = cv2.VideoCapture(0)
-    cright = cv2.VideoCapture(1)
+    stereo = StereoCapture(VideoCapture(0), VideoCapture(1))
+    stereo.start()
 
     logging.config.dictConfig(conf.logging)
     logger = logging.getLogger(__name__)
@@ -34,11 +36,10 @@ if __name__ == '__main__':
     acceptThread.start()
 
     while True:
-        _, ileft = cleft.read()
-        _, iright = cright.read()
+        pair = stereo.read_pair()
 
-        ipleft = np.rot90(ileft, 3)
-        ipright = np.rot90(iright, 3)
+        ipleft = np.rot90(pair.left.image, 3)
+        ipright = np.rot90(pair.right.image, 3)
 
         corners_left = np.concatenate(get_corners_from_image(ipleft, 1))
         corners_right = np.concatenate(get_corners_from_image(ipright, 2))
@@ -55,4 +56,5 @@ if __name__ == '__main__':
 
         if cv2.waitKey(1) == ord('q'):
             sock.close()
+            stereo.stop()
             break
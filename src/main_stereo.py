@@ -13,6 +13,8 @@ import gstreamer as gs
 import networking
 import networking.messages as m
 from processing.stereo import process
+from processing.stereocapture import StereoCapture
+from processing.videocapture import VideoCapture
 Gst = gs.Gst
 
 if __name__ == '__main__':
@@ -56,8 +58,12 @@ if __name__ == '__main__':
     leftcaps = gs.get_sink_caps(leftpipeline.get_by_name(gs.SINK_NAME))
     rightcaps = gs.get_sink_caps(rightpipeline.get_by_name(gs.SINK_NAME))
 
-    cleft = cv2.VideoCapture(gs.SHMSrc(gs.make_command_line_parsable(leftcaps)))
-    cright = cv2.VideoCapture(gs.SHMSrc(gs.make_command_line_parsable(rightcaps)))
+    # Both cameras are read at once, and frames are paired by when they
+    # were captured
+    stereo = StereoCapture(
+        VideoCapture(gs.SHMSrc(gs.make_command_line_parsable(leftcaps))),
+        VideoCapture(gs.SHMSrc(gs.make_command_line_parsable(rightcaps))))
+    stereo.start()
 
     leftdebuggingThread.stop()
     rightdebuggingThread.stop()
@@ -72,16 +78,18 @@ if __name__ == '__main__':
     acceptThread.start()
 
     while True:
-        _, ileft = cleft.read()
-        _, iright = cright.read()
+        pair = stereo.read_pair()
 
-        ipleft = np.rot90(ileft, 3)
-        ipright = np.rot90(iright, 3)
+        ipleft = np.rot90(pair.left.image, 3)
+        ipright = np.rot90(pair.right.image, 3)
 
-        points = process(ipleft, ipright, False)
-        message = m.create_message(m.TYPE_RESULTS, {m.FIELD_CORNERS: points})
-        networking.server.broadcast(sock, clis, message)
+        result = process(ipleft, ipright, False)
+        if result is not None:
+            message = m.create_message(m.TYPE_RESULTS, {
+                m.FIELD_CORNERS: [result.distance, result.offset]})
+            networking.server.broadcast(sock, clis, message)
 
         if cv2.waitKey(1) == ord('q'):
             sock.close()
+            stereo.stop()
             break
@@ -1,2 +1,2 @@
 from .handler import create_gst_handler
-from . import server
+from . import aioserver, policy, results, server, udp
@@ -0,0 +1,252 @@
+"""
+An asyncio version of the TCP socket server in server.py, which both
+manages streaming and sends image processing results to the roborio.
+
+The server runs its own event loop on a separate thread, which handles
+every client without needing a thread (or a shared client list) for
+each job. The vision loop hands results to it with `broadcast`, which
+is safe to call from any thread, and never waits for them to be sent.
+
+>>> srv = Server(handler, port=6000)
+>>> srv.start()
+>>> srv.broadcast(message)
+"""
+
+import asyncio
+from collections import deque
+import logging
+import threading
+import time
+
+from .messages import FORMAT_JSON, LEVEL_CORNERS
+from .server import (HOST, PORT, SIZE, QUEUE_SIZE, STALL_TIMEOUT,
+                     ClientStats, FrameBuffer, as_buffer)
+
+def _all_tasks(loop):
+    """Return every task of an event loop that hasn't finished."""
+    if hasattr(asyncio, 'all_tasks'):
+        return asyncio.all_tasks(loop)
+    return {t for t in asyncio.Task.all_tasks(loop) if not t.done()}
+
+class Connection(object):
+    """
+    A client connected to the server.
+
+    Like a socket, it has a send method, so it can be given to message
+    handlers. Messages sent to it are queued and written by the event
+    loop, and the oldest are dropped if the client falls behind.
+    Connections should only be used from the event loop's thread.
+    """
+
+    def __init__(self, writer, queue_size=QUEUE_SIZE):
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')
+        self.queue = deque(maxlen=queue_size)
+        self.ready = asyncio.Event() # Set when there is something to send
+        self.sent = 0 # Number of bytes written without an error
+        self.dropped = 0 # Number of messages dropped because the queue was full
+        self.closed = False
+        self.format = FORMAT_JSON # Format the client wants results in
+        self.level = LEVEL_CORNERS # Level of detail the client wants results at
+        self.rate = 0 # Maximum number of results per second, or 0 for no limit
+        self.decimation = 1 # Only the results of every nth frame are sent
+        self._results = 0 # Number of frames the client could have been sent
+        self._last_result = -float('inf') # Time results were last sent
+
+    def send(self, data, queued=None):
+        """Queue data to be sent to the client, along with the time (from
+        time.monotonic()) the results in it were handed to the server if
+        they are results."""
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append((data, queued))
+        self.ready.set()
+        return len(data)
+
+    def wants_results(self):
+        """Return True if the client should be sent the latest results,
+        going by its decimation and rate."""
+        self._results += 1
+        if self._results % self.decimation != 0:
+            return False
+        now = time.monotonic()
+        if self.rate > 0 and now - self._last_result < 1 / self.rate:
+            return False
+        self._last_result = now
+        return True
+
+    def close(self):
+        """Close the connection once everything written has been sent."""
+        self.closed = True
+        self.ready.set() # Makes the task writing to the client finish
+        self.writer.close()
+
+    def abort(self):
+        """Close the connection immediately, discarding unsent data."""
+        self.closed = True
+        self.ready.set()
+        self.writer.transport.abort()
+
+class Server(threading.Thread):
+    """
+    Thread that runs an asyncio server, calling a given function when a
+    new message is received, just like server.AcceptClients. The
+    function should take two parameters - the Connection that sent the
+    data and the message that was sent, without the newline ending it -
+    and is called on the server's thread.
+
+    Clients that don't accept any data for stall_timeout seconds while
+    there are messages waiting for them are disconnected.
+
+    If a profiler is given, the time from when results are handed to
+    send_results until they have been written to each client is recorded
+    in it as the 'send' stage.
+    """
+
+    def __init__(self, on_new_message, host=HOST, port=PORT,
+                 queue_size=QUEUE_SIZE, stall_timeout=STALL_TIMEOUT,
+                 profiler=None):
+        threading.Thread.__init__(self)
+        self.daemon = True # Makes the thread quit with the main thread
+        self.on_new_message = on_new_message
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.stall_timeout = stall_timeout
+        self.profiler = profiler
+        self.clients = [] # Only modified on the server's thread
+        self._loop = asyncio.new_event_loop()
+        self._listening = threading.Event()
+        self._error = None
+
+    def start(self):
+        """Start the thread, returning once the server is listening.
+
+        Errors in creating the server (e.g. the port being in use) are
+        raised here.
+        """
+        threading.Thread.start(self)
+        self._listening.wait()
+        if self._error is not None:
+            raise self._error
+
+    def run(self):
+        """Run the event loop until the server is stopped."""
+        asyncio.set_event_loop(self._loop)
+        try:
+            server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port))
+        except OSError as e:
+            self._error = e
+            self._listening.set()
+            return
+        self.port = server.sockets[0].getsockname()[1]
+        self._listening.set()
+
+        try:
+            self._loop.run_forever()
+        finally:
+            # Disconnecting every client makes their handlers finish
+            server.close()
+            for conn in self.clients:
+                conn.abort()
+            self._loop.run_until_complete(asyncio.gather(
+                *_all_tasks(self._loop), return_exceptions=True))
+            self._loop.close()
+
+    def subscriptions(self):
+        """Return the set of (level, format) pairs clients want results
+        in."""
+        return {(conn.level, conn.format) for conn in list(self.clients)}
+
+    def broadcast(self, message, clients=None):
+        """Queue a message to be sent to the given connections, or every
+        connection if no list is given.
+
+        The message can be a string or any buffer, such as bytes or a
+        memoryview, and is only encoded once for every connection. It
+        must not be changed once broadcast. This can be called from any
+        thread.
+        """
+        message = as_buffer(message)
+        self._loop.call_soon_threadsafe(self._broadcast, message, clients)
+
+    def _broadcast(self, message, clients):
+        """Queue a message to be sent, on the server's thread."""
+        for conn in (self.clients if clients is None else clients):
+            conn.send(message)
+
+    def send_results(self, results):
+        """Queue results to be sent to every client that wants them, given
+        a dictionary mapping (level, format) pairs to the results at that
+        level in that format.
+
+        Each message is only sent to the clients subscribed to its level
+        and format, and only as often as they asked for. This can be
+        called from any thread.
+        """
+        self._loop.call_soon_threadsafe(self._send_results, results,
+                                        time.monotonic())
+
+    def _send_results(self, results, queued):
+        """Queue results to be sent, on the server's thread."""
+        for conn in self.clients:
+            message = results.get((conn.level, conn.format))
+            if message is not None and conn.wants_results():
+                conn.send(message, queued)
+
+    def stats(self):
+        """Return a dictionary mapping each connection to the ClientStats
+        of what has been sent to it."""
+        return {conn: ClientStats(conn.sent, conn.dropped, len(conn.queue))
+                for conn in list(self.clients)}
+
+    def stop(self):
+        """Stop the server, disconnecting every client."""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def _write(self, conn):
+        """Send a connection's messages as they are queued."""
+        try:
+            while not conn.closed:
+                await conn.ready.wait()
+                conn.ready.clear()
+                while conn.queue and not conn.closed:
+                    data, queued = conn.queue.popleft()
+                    conn.writer.write(data)
+                    await asyncio.wait_for(conn.writer.drain(),
+                                           self.stall_timeout)
+                    conn.sent += len(data)
+                    if queued is not None and self.profiler is not None:
+                        self.profiler.record('send', time.monotonic() - queued)
+        except asyncio.TimeoutError:
+            logging.warning('Disconnecting stalled client')
+            conn.abort()
+        except ConnectionError:
+            conn.abort()
+
+    async def _handle(self, reader, writer):
+        """Handle a client from when it connects until it disconnects."""
+        conn = Connection(writer, self.queue_size)
+        self.clients.append(conn)
+        writer_task = asyncio.ensure_future(self._write(conn))
+        frames = FrameBuffer()
+        try:
+            while True:
+                data = await reader.read(SIZE)
+                if not data:
+                    break # Client has disconnected
+                for frame in frames.feed(data):
+                    try:
+                        self.on_new_message(conn, frame.decode('utf-8'))
+                    except UnicodeDecodeError:
+                        logging.error('Unicode error')
+                    except Exception: # pylint: disable=broad-except
+                        # A bad message shouldn't disconnect the client
+                        logging.exception('Error handling message')
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.remove(conn)
+            conn.close()
+            await writer_task
@@ -3,7 +3,7 @@ This module exports a single useful function, create_gst_handler. Its
 purpose is to separate the message-handling code from main.py to make it
 more readable and to break things up.
 
-create_gst_handler handles 3 types of messages by doing the following:
+create_gst_handler handles 9 types of messages by doing the following:
 
 Error messages: Prints out the error to stdout (because in reality this
 code, which happens to not have any tests, is absolutely perfect and the
@@ -15,18 +15,42 @@ and then re-creates it with the specified ISO and shutterspeed options
 and streams to the specified host and port
 
 Stop streaming messages: Stops the running GStreamer pipeline if any
+
+Profile messages: Replies with the timings of each processing stage and
+the latency of each step from capture to sending results, if functions
+to collect them were given
+
+Stats messages: Replies with the current value of every metric, if a
+function to collect them was given
+
+Format messages: Sets the format results are sent to the client in, if
+the client supports it (i.e. it is an aioserver.Connection)
+
+Subscribe messages: Sets the level of detail results are sent to the
+client at, and how often they are sent, if the client supports it
+
+UDP subscribe and unsubscribe messages: Starts or stops sending results
+to the given host and port over UDP, if a UDPPublisher was given
 """
 
 import logging
 from . import messages as m
 
+def send_message(client, message):
+    """Send a message string to a client, ignoring any errors."""
+    try:
+        client.send(message.encode('utf-8'))
+    except:
+        pass
+
 # Generic handlers
-def on_error(message):
+def on_error(_, message):
     """Handle an error message sent to the socket."""
     logging.error('Got error from socket: {}'.format(message[m.FIELD_ERROR]))
 
 def create_gst_handler(pipeline, src_name=None, valve_name=None,
-                       udp_name=None):
+                       udp_name=None, stats=None, latency=None,
+                       publisher=None, metrics=None):
     """Create a message handler for the given GStreamer pipeline.
 
     Besides the required pipeline, which should already be started, this
@@ -44,15 +68,25 @@ def create_gst_handler(pipeline, src_name=None, valve_name=None,
     does not support settings iso and shutter speed, then not providing
     a src_name will make the code not handle setting the iso and
     shutterspeed of the camera, but will not break anything else.
+
+    The optional stats parameter is a function returning a dictionary
+    of stage timings (e.g. `Profiler.stats`), which is sent back to
+    clients that ask for it with a profile message. Likewise, latency is
+    a function returning the latency statistics sent with it, and
+    metrics is a function returning the values of metrics (e.g.
+    `Registry.collect`), which are sent in reply to a stats message.
+
+    If a udp.UDPPublisher is given as publisher, clients can subscribe
+    to it.
     """
 
-    def on_stop(_):
+    def on_stop(*_):
         """Handle a message to stop the GStreamer pipeline."""
         logging.debug('Stopping video stream')
         if valve_name is not None:
             pipeline.get_by_name(valve_name).set_property('drop', True)
 
-    def on_start(message):
+    def on_start(_, message):
         """Handle a message to start the GStreamer pipeline."""
         logging.debug('Starting video stream, {}:{} with ISO {} and SS {}'
                       .format(message[m.FIELD_HOST], message[m.FIELD_PORT],
@@ -70,10 +104,81 @@ def create_gst_handler(pipeline, src_name=None, valve_name=None,
         if valve_name is not None:
             pipeline.get_by_name(valve_name).set_property('drop', False)
 
+    def on_profile(client, _):
+        """Handle a message asking for the processing stage timings."""
+        fields = {}
+        if stats is not None:
+            fields[m.FIELD_STAGES] = stats()
+        if latency is not None:
+            fields[m.FIELD_LATENCY] = latency()
+        if fields:
+            send_message(client, m.create_message(m.TYPE_PROFILE, fields))
+
+    def on_stats(client, _):
+        """Handle a message asking for the values of the metrics."""
+        if metrics is not None:
+            send_message(client, m.create_message(m.TYPE_STATS, {
+                m.FIELD_METRICS: metrics()}))
+
+    def check_format(message_format):
+        """Raise a ValueError if a format isn't understood."""
+        if message_format not in m.FORMATS:
+            raise ValueError('Format {} is not understood'
+                             .format(message_format))
+
+    def on_format(client, message):
+        """Handle a message choosing the format of results."""
+        check_format(message[m.FIELD_FORMAT])
+        if not hasattr(client, 'format'):
+            raise ValueError('Formats other than JSON are not supported')
+        client.format = message[m.FIELD_FORMAT]
+
+    def check_level(level):
+        """Raise a ValueError if a level of detail isn't understood."""
+        if level not in m.LEVELS:
+            raise ValueError('Level {} is not understood'.format(level))
+
+    def on_subscribe(client, message):
+        """Handle a message choosing which results are sent."""
+        check_level(message[m.FIELD_LEVEL])
+        rate = message[m.FIELD_RATE]
+        decimation = message[m.FIELD_DECIMATION]
+        if rate < 0:
+            raise ValueError('Rate must be at least 0')
+        if decimation < 1:
+            raise ValueError('Decimation must be an integer that is at least 1')
+        if not hasattr(client, 'level'):
+            raise ValueError('Subscriptions are not supported')
+        client.level = message[m.FIELD_LEVEL]
+        client.rate = rate
+        client.decimation = decimation
+
+    def on_udp_subscribe(_, message):
+        """Handle a message to start sending results over UDP."""
+        message_format = message[m.FIELD_FORMAT]
+        level = message[m.FIELD_LEVEL]
+        check_format(message_format)
+        check_level(level)
+        if publisher is None:
+            raise ValueError('Results are not sent over UDP')
+        publisher.subscribe(message[m.FIELD_HOST], message[m.FIELD_PORT],
+                            message_format, level)
+
+    def on_udp_unsubscribe(_, message):
+        """Handle a message to stop sending results over UDP."""
+        if publisher is not None:
+            publisher.unsubscribe(message[m.FIELD_HOST], message[m.FIELD_PORT])
+
     handlers = {
         m.TYPE_ERROR: on_error,
         m.TYPE_START_STREAM: on_start,
-        m.TYPE_STOP_STREAM: on_stop
+        m.TYPE_STOP_STREAM: on_stop,
+        m.TYPE_PROFILE: on_profile,
+        m.TYPE_STATS: on_stats,
+        m.TYPE_FORMAT: on_format,
+        m.TYPE_SUBSCRIBE: on_subscribe,
+        m.TYPE_UDP_SUBSCRIBE: on_udp_subscribe,
+        m.TYPE_UDP_UNSUBSCRIBE: on_udp_unsubscribe
     }
 
     def handle_message(client, message_str):
@@ -83,12 +188,13 @@ def create_gst_handler(pipeline, src_name=None, valve_name=None,
         """
         try:
             message = m.parse_message(message_str)
-            handlers[message[m.FIELD_TYPE]](message)
+            handler = handlers.get(message[m.FIELD_TYPE])
+            if handler is None:
+                raise ValueError('Messages of type {} are not handled'
+                                 .format(message[m.FIELD_TYPE]))
+            handler(client, message)
         except ValueError as e:
             msg = m.create_message(m.TYPE_ERROR, {m.FIELD_ERROR: str(e)})
-            try:
-                client.send(msg.encode('utf-8'))
-            except:
-                pass
+            send_message(client, msg)
 
     return handle_message
@@ -13,9 +13,28 @@ example of a message:
     "iso": 500,
     "shutterspeed": 2000
 }
+
+Clients can instead ask for results to be sent to them in a compact
+binary format by sending a format message. Binary messages are told
+apart from JSON ones (which are still used for everything else) by
+their first byte, which is always 0. See create_binary_message for the
+layout.
 """
 
 import json
+import math
+import struct
+
+import numpy as np
+
+# Messages are parsed with the fastest JSON library that is installed
+try:
+    from orjson import loads as _loads
+except ImportError:
+    try:
+        from ujson import loads as _loads
+    except ImportError:
+        _loads = json.loads
 
 # Message types
 TYPE_START_STREAM = 'start'
@@ -23,6 +42,12 @@ TYPE_STOP_STREAM = 'stop'
 TYPE_ERROR = 'error'
 TYPE_RESULTS = 'results'
 TYPE_SIMPLERESULTS = 'simpleresults'
+TYPE_PROFILE = 'profile'
+TYPE_FORMAT = 'format'
+TYPE_UDP_SUBSCRIBE = 'udpsubscribe'
+TYPE_UDP_UNSUBSCRIBE = 'udpunsubscribe'
+TYPE_SUBSCRIBE = 'subscribe'
+TYPE_STATS = 'stats'
 
 # Fields
 FIELD_TYPE = 'type'
@@ -33,6 +58,40 @@ FIELD_SS = 'shutterspeed'
 FIELD_ERROR = 'message'
 FIELD_CORNERS = 'corners'
 FIELD_XDISP = 'xdisplacement'
+FIELD_STAGES = 'stages'
+FIELD_TIMESTAMP = 'timestamp' # Time the frame was captured at, in seconds
+FIELD_LATENCY = 'latency' # Milliseconds from capture until the message was made
+FIELD_SEQ = 'seq' # Number of the frame the results are from
+FIELD_VALID = 'valid'
+FIELD_FORMAT = 'format'
+FIELD_LEVEL = 'level'
+FIELD_RATE = 'rate' # Maximum number of results per second, or 0 for no limit
+FIELD_DECIMATION = 'decimation' # Only the results of every nth frame are sent
+FIELD_METRICS = 'metrics'
+
+# Formats results can be sent in
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
+FORMATS = (FORMAT_JSON, FORMAT_BINARY)
+
+# Levels of detail results can be sent at
+LEVEL_SUMMARY = 'summary' # Only the top left and bottom right of the target
+LEVEL_CORNERS = 'corners' # The corners of the target
+LEVEL_FULL = 'full' # Every contour that could be a target as well
+LEVELS = (LEVEL_SUMMARY, LEVEL_CORNERS, LEVEL_FULL)
+
+# Binary messages start with a header of a 0 byte, the message type's code,
+# the length of the whole message, the frame number, the capture timestamp
+# and the latency (NaN if they aren't known)
+BINARY_HEADER = struct.Struct('<cBIIdf')
+BINARY_MARKER = b'\0'
+BINARY_TYPES = {
+    TYPE_RESULTS: 1,
+    TYPE_SIMPLERESULTS: 2
+}
+BINARY_COUNTS = struct.Struct('<HH') # Number of corner and valid arrays
+BINARY_POINTS = struct.Struct('<H') # Number of points in an array
+BINARY_XDISP = struct.Struct('<i')
 
 # Message schemas
 MESSAGES = {
@@ -51,37 +110,186 @@ MESSAGES = {
     },
     TYPE_SIMPLERESULTS: {
         FIELD_XDISP: int
+    },
+    TYPE_PROFILE: {},
+    TYPE_STATS: {},
+    TYPE_FORMAT: {
+        FIELD_FORMAT: str
+    },
+    TYPE_UDP_SUBSCRIBE: {
+        FIELD_HOST: str,
+        FIELD_PORT: int
+    },
+    TYPE_UDP_UNSUBSCRIBE: {
+        FIELD_HOST: str,
+        FIELD_PORT: int
+    },
+    TYPE_SUBSCRIBE: {
+        FIELD_LEVEL: str
+    }
+}
+
+# Fields messages can leave out, with their types and the values they are
+# given when they are left out
+OPTIONAL_FIELDS = {
+    TYPE_UDP_SUBSCRIBE: {
+        FIELD_FORMAT: (str, FORMAT_JSON),
+        FIELD_LEVEL: (str, LEVEL_CORNERS)
+    },
+    TYPE_SUBSCRIBE: {
+        FIELD_RATE: ((int, float), 0),
+        FIELD_DECIMATION: (int, 1)
     }
 }
 
+def _type_name(types):
+    """Return the name of a type or tuple of types for error messages."""
+    if isinstance(types, tuple):
+        return ' or '.join(t.__name__ for t in types)
+    return types.__name__
+
+def _compile_schema(required, optional):
+    """Return a function that checks a message has the required fields of
+    the right types and fills in the optional fields it leaves out.
+
+    The fields are turned into tuples once so that checking a message is
+    a single pass over them, and error messages are only built for
+    messages that are invalid.
+    """
+    required = tuple(required.items())
+    optional = tuple((f, t, d) for f, (t, d) in optional.items())
+
+    def bad_type(field, value, types):
+        """Raise an error for a field of the wrong type."""
+        raise ValueError('Field {} is of type {} and not of type {}'.format(
+            field, type(value).__name__, _type_name(types)))
+
+    def validate(message):
+        """Validate a message, filling in its defaults."""
+        for field, types in required:
+            try:
+                value = message[field]
+            except KeyError:
+                raise ValueError('Message does not contain required field {}'
+                                 .format(field))
+            if not isinstance(value, types):
+                bad_type(field, value, types)
+        for field, types, default in optional:
+            value = message.setdefault(field, default)
+            if not isinstance(value, types):
+                bad_type(field, value, types)
+
+    return validate
+
+_VALIDATORS = {t: _compile_schema(schema, OPTIONAL_FIELDS.get(t, {}))
+               for t, schema in MESSAGES.items()}
+
 def parse_message(message_str):
     """Take in a message as a string, validate it, and output json.
 
     While this function will raise a ValueError if the message is
     missing required fields, it will not throw any errors if it includes
-    extra ones.
+    extra ones. Optional fields that are left out are given their
+    defaults.
     """
-    message = json.loads(message_str) # Raises a ValueError if json is invalid
-    if 'type' not in message:
+    message = _loads(message_str) # Raises a ValueError if json is invalid
+    if not isinstance(message, dict) or FIELD_TYPE not in message:
         raise ValueError('Message does not have a type field')
-    if message['type'] not in MESSAGES:
+    try:
+        validate = _VALIDATORS[message[FIELD_TYPE]]
+    except (KeyError, TypeError):
         raise ValueError('Message type is not understood')
-
-    message_schema = MESSAGES[message['type']]
-    for field in message_schema:
-        if field not in message:
-            raise ValueError(
-                'Message does not contain required field {}'.format(field))
-        if not isinstance(message[field], message_schema[field]):
-            t1 = type(message[field]).__name__
-            t2 = message_schema[field].__name__
-            raise ValueError((
-                'Field {} is of type {} and not of type {}'
-                ).format(field, t1, t2))
-
+    validate(message)
     return message
 
 def create_message(message_type, fields):
     """Create a message string from a given tyoe and fields."""
     message = dict({FIELD_TYPE: message_type}, **fields)
     return json.dumps(message) + '\n'
+
+def _pack_points(arrays):
+    """Return the number of arrays of points and a list of bytes of each
+    array's int16 x and y pairs, preceded by the number of points in it.
+    """
+    out = []
+    for points in arrays:
+        points = np.asarray(points, '<i2').reshape(-1, 2)
+        out.append(BINARY_POINTS.pack(len(points)))
+        out.append(points.tobytes())
+    return len(arrays), out
+
+def _unpack_points(data, offset, n):
+    """Return n arrays of points packed by _pack_points, starting at the
+    offset, and the offset after them."""
+    arrays = []
+    for _ in range(n):
+        count, = BINARY_POINTS.unpack_from(data, offset)
+        offset += BINARY_POINTS.size
+        points = np.frombuffer(data, '<i2', count * 2, offset)
+        arrays.append(points.reshape(-1, 2).tolist())
+        offset += count * 4
+    return arrays, offset
+
+def create_binary_message(message_type, fields):
+    """Create a binary message from a given results type and fields.
+
+    After the header, results messages contain the number of arrays of
+    corners and of valid contours, followed by each array as the number
+    of points in it and then the int16 x and y of each point. Simple
+    results messages contain the int32 x displacement.
+    """
+    if message_type == TYPE_RESULTS:
+        ncorners, corners = _pack_points(fields[FIELD_CORNERS])
+        nvalid, valid = _pack_points(fields.get(FIELD_VALID, []))
+        body = [BINARY_COUNTS.pack(ncorners, nvalid)] + corners + valid
+    elif message_type == TYPE_SIMPLERESULTS:
+        body = [BINARY_XDISP.pack(fields[FIELD_XDISP])]
+    else:
+        raise ValueError('Messages of type {} can\'t be binary'
+                         .format(message_type))
+
+    length = BINARY_HEADER.size + sum(len(b) for b in body)
+    header = BINARY_HEADER.pack(BINARY_MARKER, BINARY_TYPES[message_type],
+                                length, fields.get(FIELD_SEQ, 0),
+                                fields.get(FIELD_TIMESTAMP, math.nan),
+                                fields.get(FIELD_LATENCY, math.nan))
+    return b''.join([header] + body)
+
+def parse_binary_message(data):
+    """Take in a binary message as bytes and output the message it
+    contains, in the same form as parse_message does for JSON.
+
+    Corners are returned as lists of [x, y] points.
+    """
+    if len(data) < BINARY_HEADER.size or data[:1] != BINARY_MARKER:
+        raise ValueError('Message is not binary')
+    _, code, length, seq, timestamp, latency = BINARY_HEADER.unpack_from(data)
+    if len(data) != length:
+        raise ValueError('Message is {} bytes and not {}'.format(len(data),
+                                                                 length))
+    types = {v: k for k, v in BINARY_TYPES.items()}
+    if code not in types:
+        raise ValueError('Message type is not understood')
+
+    message = {FIELD_TYPE: types[code], FIELD_SEQ: seq}
+    if not math.isnan(timestamp):
+        message[FIELD_TIMESTAMP] = timestamp
+    if not math.isnan(latency):
+        message[FIELD_LATENCY] = latency
+
+    offset = BINARY_HEADER.size
+    if types[code] == TYPE_RESULTS:
+        ncorners, nvalid = BINARY_COUNTS.unpack_from(data, offset)
+        offset += BINARY_COUNTS.size
+        message[FIELD_CORNERS], offset = _unpack_points(data, offset, ncorners)
+        if nvalid > 0:
+            message[FIELD_VALID], offset = _unpack_points(data, offset, nvalid)
+    else:
+        message[FIELD_XDISP], = BINARY_XDISP.unpack_from(data, offset)
+    return message
+
+def create_message_as(message_format, message_type, fields):
+    """Create a message in the given format, as bytes."""
+    if message_format == FORMAT_BINARY:
+        return create_binary_message(message_type, fields)
+    return create_message(message_type, fields).encode('utf-8')
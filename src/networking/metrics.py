@@ -0,0 +1,280 @@
+"""
+A registry of metrics about how the vision process is doing, which can
+be watched during a match without attaching a debugger.
+
+There are three kinds of metrics: counters, which only go up (e.g. the
+number of frames captured), gauges, which go up and down (e.g. how many
+messages are waiting for a client), and histograms, which count how
+many observations (e.g. latencies) fall into each of a fixed set of
+buckets. Counters and gauges can instead be given a function that is
+called for their value whenever the metrics are collected, so values
+kept elsewhere (like the bytes sent to each client) don't need to be
+copied into the registry as they change.
+
+The metrics are served in Prometheus' text format over HTTP by a
+MetricsServer, and sent to clients that send a stats message.
+
+>>> frames = METRICS.counter('frames_captured', 'Frames captured')
+>>> frames.inc()
+>>> MetricsServer(METRICS).start()
+"""
+
+import bisect
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+import math
+import threading
+
+from .server import HOST
+
+METRICS_PORT = 5805 # In the range of ports teams can use on the field
+PREFIX = 'vision_' # Added to the start of the name of every metric
+LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.15, 0.25,
+                   0.5, 1) # Upper bounds of latency buckets, in seconds
+
+def _format_value(value):
+    """Return a value as it is written in the text format."""
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _escape(value):
+    """Escape a label value for the text format."""
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+class _Metric(object):
+    """A counter or gauge, which has a single value, or a value for each
+    value of its label if it has one."""
+
+    kind = None
+
+    def __init__(self, name, description, function=None, label=None):
+        self.name = PREFIX + name
+        self.description = description
+        self.function = function # Called for the value if given
+        self.label = label # Name of the label the function's values are for
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Increase the value."""
+        with self._lock:
+            self._value += amount
+
+    def value(self):
+        """Return the value, or a dictionary mapping each value of the
+        label to the metric's value for it."""
+        if self.function is not None:
+            return self.function()
+        return self._value
+
+    def samples(self):
+        """Return a list of (name, labels, value) tuples of the metric's
+        values, where labels is a dictionary."""
+        value = self.value()
+        if self.label is None:
+            return [(self.name, {}, value)]
+        return [(self.name, {self.label: k}, v)
+                for k, v in sorted(value.items())]
+
+class Counter(_Metric):
+    """A metric that only goes up."""
+
+    kind = 'counter'
+
+class Gauge(_Metric):
+    """A metric that can go up and down."""
+
+    kind = 'gauge'
+
+    def set(self, value):
+        """Set the value."""
+        with self._lock:
+            self._value = value
+
+    def dec(self, amount=1):
+        """Decrease the value."""
+        self.inc(-amount)
+
+class Histogram(object):
+    """
+    Counts how many observations are at most each of a fixed set of
+    bucket bounds, along with their number and sum.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = PREFIX + name
+        self.description = description
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._counts = [0] * len(self.buckets)
+        self._sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Add an observation to the bucket it falls in."""
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def value(self):
+        """Return a dictionary with a list of each bucket's bound (as a
+        string, since the last is infinite) and cumulative count, and the
+        number and sum of the observations."""
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            buckets.append((_format_value(bound), cumulative))
+        return {'buckets': buckets, 'count': cumulative, 'sum': total}
+
+    def samples(self):
+        """Return a list of (name, labels, value) tuples of the bucket
+        counts, count and sum."""
+        value = self.value()
+        samples = [(self.name + '_bucket', {'le': bound}, n)
+                   for bound, n in value['buckets']]
+        samples.append((self.name + '_count', {}, value['count']))
+        samples.append((self.name + '_sum', {}, value['sum']))
+        return samples
+
+class Registry(object):
+    """
+    A set of metrics, which can be collected as a dictionary or written
+    in Prometheus' text format.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def add(self, metric):
+        """Add a metric to the registry and return it."""
+        with self._lock:
+            if any(m.name == metric.name for m in self._metrics):
+                raise ValueError('Metric {} already exists'.format(metric.name))
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, function=None, label=None):
+        """Create a Counter in the registry."""
+        return self.add(Counter(name, description, function, label))
+
+    def gauge(self, name, description, function=None, label=None):
+        """Create a Gauge in the registry."""
+        return self.add(Gauge(name, description, function, label))
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        """Create a Histogram in the registry."""
+        return self.add(Histogram(name, description, buckets))
+
+    def collect(self):
+        """Return a dictionary mapping the name of each metric to its
+        value, for sending in a stats message."""
+        with self._lock:
+            metrics = list(self._metrics)
+        values = {}
+        for metric in metrics:
+            try:
+                values[metric.name] = metric.value()
+            except Exception: # pylint: disable=broad-except
+                logging.exception('Could not collect {}'.format(metric.name))
+        return values
+
+    def expose(self):
+        """Return every metric in Prometheus' text format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name,
+                                               metric.description))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            try:
+                samples = metric.samples()
+            except Exception: # pylint: disable=broad-except
+                logging.exception('Could not collect {}'.format(metric.name))
+                continue
+            for name, labels, value in samples:
+                if labels:
+                    name += '{{{}}}'.format(','.join(
+                        '{}="{}"'.format(k, _escape(v))
+                        for k, v in sorted(labels.items())))
+                lines.append('{} {}'.format(name, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+METRICS = Registry()
+
+# The metrics a vision loop updates as it processes frames: the counters of
+# frames processed and frames the target was found in, and the histogram of
+# seconds from capture until processed
+FrameMetrics = namedtuple('FrameMetrics', ['processed', 'detected', 'latency'])
+
+def add_frame_metrics(capture, registry=METRICS):
+    """Add the metrics about the frames read from a capture (anything with
+    pulled and dropped counts, like gstreamer.AppSinkCapture) and
+    processed by a vision loop to a registry, and return the FrameMetrics
+    the loop should update."""
+    registry.counter('frames_captured_total', 'Frames pulled from the camera',
+                     lambda: capture.pulled)
+    registry.counter('frames_dropped_total',
+                     'Frames dropped before they could be pulled',
+                     lambda: capture.dropped)
+    processed = registry.counter('frames_processed_total', 'Frames processed')
+    detected = registry.counter('frames_detected_total',
+                                'Frames the target was found in')
+    registry.gauge('detection_rate',
+                   'Fraction of frames the target was found in',
+                   lambda: detected.value() / max(processed.value(), 1))
+    latency = registry.histogram('processing_latency_seconds',
+                                 'Seconds from capture until processed')
+    return FrameMetrics(processed, detected, latency)
+
+class MetricsServer(threading.Thread):
+    """
+    Thread that serves the metrics of a registry over HTTP, at /metrics.
+    """
+
+    def __init__(self, registry=METRICS, host=HOST, port=METRICS_PORT):
+        threading.Thread.__init__(self)
+        self.daemon = True # Makes the thread quit with the main thread
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            """Responds to requests for the metrics."""
+
+            def do_GET(self): # pylint: disable=invalid-name
+                """Send the metrics."""
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.expose().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args): # pylint: disable=arguments-differ
+                """Don't log every request."""
+                pass
+
+        self.httpd = HTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+
+    def run(self):
+        """Serve requests until the server is stopped."""
+        self.httpd.serve_forever()
+        self.httpd.server_close()
+
+    def stop(self):
+        """Stop the server."""
+        self.httpd.shutdown()
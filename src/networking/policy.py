@@ -0,0 +1,68 @@
+"""
+Code to decide which results are worth sending to clients.
+
+The target barely moves between most frames, so sending the results of
+every frame mostly repeats the last ones. A PublishPolicy only lets
+results through when they differ from the last ones sent by more than
+a few pixels, so a moving target is still sent on the frame it moves,
+while a still one is only sent every so often to show that the vision
+code is still running.
+
+>>> policy = PublishPolicy()
+>>> if policy.should_publish(corners):
+...     server.send_results(results)
+"""
+
+import time
+
+import numpy as np
+
+TOLERANCE = 2 # Pixels any corner must move by for results to be sent again
+KEEPALIVE = 1 # Seconds after which the same results are sent again
+
+class PublishPolicy(object):
+    """
+    Decides whether the corners found in a frame should be sent.
+
+    Corners are sent if they are the first ones, if any corner has moved
+    by more than tolerance pixels (or the number of corners has changed)
+    since the last ones sent, or if nothing has been sent for keepalive
+    seconds. No corners (an empty list, when the target isn't found) are
+    treated the same way, so losing or finding the target is sent
+    straight away and a lost target is still sent every so often. Limiting how often each client is sent results is done by
+    the server, with the rate clients subscribe with.
+    """
+
+    def __init__(self, tolerance=TOLERANCE, keepalive=KEEPALIVE,
+                 clock=time.monotonic):
+        self.tolerance = tolerance
+        self.keepalive = keepalive
+        self.clock = clock
+        self.sent = 0 # Number of results let through
+        self.suppressed = 0 # Number of results that weren't sent
+        self._last = None # Corners last sent
+        self._last_time = -float('inf') # Time they were sent
+
+    def changed(self, corners):
+        """Return True if corners (as an array of points) differ
+        significantly from the last ones sent."""
+        if self._last is None or corners.shape != self._last.shape:
+            return True
+        return bool(np.any(np.abs(corners - self._last) > self.tolerance))
+
+    def should_publish(self, corners):
+        """Return True if corners (a list of arrays of points, not a
+        bounding box, which is empty if the target wasn't found) should
+        be sent, remembering them as the last ones sent if so."""
+        if len(corners) > 0:
+            corners = np.concatenate(corners).reshape(-1, 2).astype(np.float64)
+        else:
+            corners = np.empty((0, 2))
+        now = self.clock()
+        if self.changed(corners) or now - self._last_time >= self.keepalive:
+            self._last = corners
+            self._last_time = now
+            self.sent += 1
+            return True
+        self.suppressed += 1
+        return False
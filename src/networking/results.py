@@ -0,0 +1,67 @@
+"""
+Code to build the results of a frame and send them to every client.
+
+Results are sent at several levels of detail (just the bounds of the
+target, its corners, or everything), in whichever formats clients asked
+for. create_levels makes the fields of each level from the corners
+found in a frame, and send_results serializes each level and format
+that anyone wants once and sends it to them.
+
+>>> levels = create_levels(corners)
+>>> send_results(seq, {FIELD_TIMESTAMP: timestamp}, levels, server, publisher)
+"""
+
+import numpy as np
+
+from . import messages as m
+
+def create_levels(corners, valid=None):
+    """Return a dictionary mapping each level of detail to the fields of
+    the results at that level.
+
+    corners is a list of arrays of the (x, y) corners of the target,
+    which is empty if it wasn't found. The summary level has the top
+    left and bottom right of the bounds of every corner instead, or no
+    corners if there aren't any. valid, the points of every contour that
+    could be a target, is only sent at the full level.
+    """
+    corns = [[(int(x), int(y)) for x, y in np.asarray(c).reshape(-1, 2)]
+             for c in corners]
+    points = [p for c in corns for p in c]
+    summary = []
+    if points:
+        xs, ys = zip(*points)
+        summary = [[(min(xs), min(ys)), (max(xs), max(ys))]]
+
+    full = {m.FIELD_CORNERS: corns}
+    if valid is not None:
+        full[m.FIELD_VALID] = valid
+    return {
+        m.LEVEL_SUMMARY: {m.FIELD_CORNERS: summary},
+        m.LEVEL_CORNERS: {m.FIELD_CORNERS: corns},
+        m.LEVEL_FULL: full
+    }
+
+def send_results(seq, fields, levels, server, publisher=None):
+    """Send the results of a frame to the clients of an aioserver.Server
+    and the subscribers of a udp.UDPPublisher (if one is given), and
+    return a dictionary mapping each (level, format) pair sent to the
+    message sent for it.
+
+    Every level is sent with the frame's sequence number and the given
+    fields (e.g. its timestamp), along with its own fields from levels.
+    Each level and format anyone wants is only serialized once.
+    """
+    subscriptions = server.subscriptions()
+    if publisher is not None:
+        subscriptions |= publisher.subscriptions()
+    fields = dict(fields, **{m.FIELD_SEQ: seq})
+    results = {
+        (level, f): m.create_message_as(f, m.TYPE_RESULTS,
+                                        dict(fields, **levels[level]))
+        for level, f in subscriptions
+    }
+    server.send_results(results)
+    if publisher is not None:
+        publisher.publish(results)
+    return results
@@ -3,6 +3,7 @@ Code to launch the TCP socket server that will both manage streaming and
 send image processing results to the roborio
 """
 
+from collections import namedtuple
 import logging
 import select
 import socket
@@ -12,7 +13,12 @@ import time
 HOST = '0.0.0.0' # For accepting connections from any device
 PORT = 6000
 BACKLOG = 5 # Maximum number of clients
-SIZE = 1024 # Maximum message size
+SIZE = 1024 # Number of bytes read from a client at once
+MAX_FRAME_SIZE = 65536 # Maximum size of a message received from a client
+QUEUE_SIZE = 4 # Number of messages waiting to be sent to a client before the
+               # oldest ones are dropped
+STALL_TIMEOUT = 2 # Seconds a client can go without accepting any data before
+                  # it is disconnected
 
 def create_socket_and_client_list(host=HOST, port=PORT, backlog=BACKLOG):
     """
@@ -25,26 +31,90 @@ def create_socket_and_client_list(host=HOST, port=PORT, backlog=BACKLOG):
     clients = [s]
     return (s, clients)
 
+# Number of bytes sent to a client, messages dropped for it and messages
+# waiting to be sent to it
+ClientStats = namedtuple('ClientStats', ['sent', 'dropped', 'queued'])
+
+def as_buffer(message):
+    """Return a memoryview of the bytes of a message, encoding it first
+    if it is a string, so that it can be sent to any number of clients
+    without being encoded or copied again."""
+    if isinstance(message, str):
+        message = message.encode('utf-8')
+    return memoryview(message).cast('B')
+
 def broadcast(server_socket, clients, message):
     """
-    Send a message to all given clients.
+    Send a message (a string, bytes, or any other buffer) to all given
+    clients, returning a dictionary mapping each client to the number
+    of bytes sent to it, which is 0 if the message couldn't be sent.
+
+    The message is only encoded once, however many clients there are.
     """
+    data = as_buffer(message)
+    sent = {}
     for i in clients:
         if i is not server_socket:
             try:
-                i.send(message.encode('utf-8'))
+                i.sendall(data)
+                sent[i] = len(data)
             except:
-                pass
+                sent[i] = 0
+    return sent
+
+class FrameBuffer(object):
+    """
+    Splits the data received from a client into messages, which are
+    separated by newlines.
+
+    Data is fed in as it is received, and only complete messages are
+    returned, so messages split across reads are joined back together
+    and reads containing several messages are split up. Messages longer
+    than max_size are dropped.
+    """
+
+    def __init__(self, max_size=MAX_FRAME_SIZE):
+        self.max_size = max_size
+        self._data = bytearray()
+        self._discarding = False # Whether the current message is too long
+
+    def feed(self, data):
+        """Add received data to the buffer, returning a list of the
+        messages it completes (without their newlines)."""
+        self._data += data
+        frames = []
+        start = 0
+        end = self._data.find(b'\n')
+        while end != -1:
+            if self._discarding:
+                self._discarding = False
+            elif end - start > self.max_size:
+                logging.error('Dropped message of {} bytes'.format(end - start))
+            else:
+                frames.append(bytes(self._data[start:end]))
+            start = end + 1
+            end = self._data.find(b'\n', start)
+        del self._data[:start]
+
+        if len(self._data) > self.max_size:
+            if not self._discarding:
+                logging.error('Dropping message longer than {} bytes'
+                              .format(self.max_size))
+            self._discarding = True
+            del self._data[:]
+        return frames
 
 def AcceptClients(server_socket, clients, on_new_message):
     """
     Accept connections from clients, calling a given function when a
     new message is received. This function should take two parameters -
-    the socket that sent the data and the data that was sent.
+    the socket that sent the data and the message that was sent, without
+    the newline ending it.
 
     This function has a side effect of modifying the client array as new
     clients connect.
     """
+    buffers = {} # Data received from each client that isn't a whole message
     while True:
         # See if there is any activity
         try:
@@ -54,21 +124,25 @@ def AcceptClients(server_socket, clients, on_new_message):
                     # Client has connected to the server
                     client_socket, _ = server_socket.accept() # 2nd arg is address
                     clients.append(client_socket)
+                    buffers[client_socket] = FrameBuffer()
                 else:
                     # A client did something
                     try:
                         data = x.recv(SIZE)
-                        if data:
-                            # Client has sent something
-                            on_new_message(x, data.decode('utf-8'))
-                        else:
-                            # Client has disconnected
-                            x.close()
-                            clients.remove(x)
-                    except UnicodeDecodeError:
-                        logging.error('Unicode error')
                     except ConnectionResetError:
-                        pass
+                        data = b''
+                    if data:
+                        # Client has sent something
+                        for frame in buffers[x].feed(data):
+                            try:
+                                on_new_message(x, frame.decode('utf-8'))
+                            except UnicodeDecodeError:
+                                logging.error('Unicode error')
+                    else:
+                        # Client has disconnected
+                        x.close()
+                        clients.remove(x)
+                        del buffers[x]
         except:
             pass
 
@@ -78,7 +152,7 @@ if __name__ == '__main__':
     def new_message(_, data):
         """Handle a new message from the server."""
         print('Got {}'.format(data))
-        broadcast(sock, clis, data)
+        broadcast(sock, clis, data + '\n')
 
     acceptThread = threading.Thread(target=AcceptClients,
                                     args=[sock, clis, new_message])
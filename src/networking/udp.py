@@ -0,0 +1,99 @@
+"""
+Code to send image processing results to the roborio over UDP.
+
+Results sent over the TCP server arrive in order, so a single lost
+packet holds up every newer result until it is resent. Results sent
+over UDP are each in their own datagram instead, which is simply lost
+if a packet is. Every results message has the number of the frame it
+came from, so receivers can drop any datagram with a lower number than
+the last one they got.
+
+Clients subscribe an address (which can be a multicast group), given as
+a numeric IP address, to the results with a udpsubscribe message, and
+unsubscribe it with a udpunsubscribe message.
+"""
+
+import ipaddress
+import logging
+import socket
+import threading
+
+from .messages import FORMAT_JSON, LEVEL_CORNERS
+
+MULTICAST_TTL = 1 # Keeps multicast results on the local network
+
+def resolve(host, port):
+    """Return the (ip, port) address of a host and port.
+
+    Only numeric IPv4 addresses are accepted. Looking a name up (like a
+    roboRIO's mDNS name) can take seconds, and subscriptions are made on
+    the server's thread, where that would hold up every client. A
+    ValueError is raised if the host isn't an IPv4 address or the port
+    isn't a valid port number.
+    """
+    if not 0 < port < 65536:
+        raise ValueError('Port {} is not between 1 and 65535'.format(port))
+    try:
+        ip = ipaddress.IPv4Address(host)
+    except ValueError:
+        raise ValueError('Host {} is not an IPv4 address'.format(host))
+    return str(ip), port
+
+class UDPPublisher(object):
+    """
+    Sends results to a set of subscribed addresses over UDP.
+
+    Subscriptions can be changed from any thread, e.g. the server's,
+    while results are published from the vision loop.
+    """
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL,
+                             MULTICAST_TTL)
+        self._subscribers = {} # Level and format of each address's results
+        self._lock = threading.Lock()
+
+    def subscribe(self, host, port, message_format=FORMAT_JSON,
+                  level=LEVEL_CORNERS):
+        """Start sending results to an address at the given level of
+        detail in the given format."""
+        address = resolve(host, port)
+        with self._lock:
+            self._subscribers[address] = (level, message_format)
+
+    def unsubscribe(self, host, port):
+        """Stop sending results to an address."""
+        address = resolve(host, port)
+        with self._lock:
+            self._subscribers.pop(address, None)
+
+    def subscriptions(self):
+        """Return the set of (level, format) pairs subscribers want results
+        in."""
+        with self._lock:
+            return set(self._subscribers.values())
+
+    def publish(self, results):
+        """Send results to every subscriber, given a dictionary mapping
+        (level, format) pairs to the results at that level in that format
+        (as bytes).
+
+        Messages that can't be sent right away are dropped.
+        """
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        for address, subscription in subscribers:
+            message = results.get(subscription)
+            if message is None:
+                continue
+            try:
+                self.sock.sendto(message, address)
+            except (OSError, OverflowError) as e:
+                logging.debug('Could not send results to {}: {}'
+                              .format(address, e))
+
+    def close(self):
+        """Close the socket results are sent from."""
+        self.sock.close()
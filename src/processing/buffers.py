@@ -0,0 +1,35 @@
+"""
+This module contains the BufferPool class, which hands out arrays that
+are reused from frame to frame so that the processing loop doesn't
+allocate new images for every frame.
+"""
+
+import numpy as np
+
+class BufferPool(object):
+    """
+    A set of named buffers that only grow, never shrink.
+
+    Asking for a buffer returns an array of the requested shape backed
+    by the same memory as the last buffer with that name, as long as it
+    is large enough. Because of this, the contents of a buffer are only
+    valid until the next time a buffer with the same name is requested.
+    A pool should not be shared between threads.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape, dtype=np.uint8):
+        """Return a contiguous array with the given shape and type."""
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        buf = self._buffers.get(name)
+        if buf is None or buf.dtype != dtype or buf.size < size:
+            buf = np.empty(size, dtype)
+            self._buffers[name] = buf
+        return buf[:size].reshape(shape)
+
+    def nbytes(self):
+        """Return the total size of all of the buffers in bytes."""
+        return sum(b.nbytes for b in self._buffers.values())
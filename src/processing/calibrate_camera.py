@@ -53,6 +53,7 @@ def calibrate(image_paths, calibration_file):
         with open(calibration_file, 'wb') as f:
             pickle.dump(d, f)
         print(d["camera_matrix"])
+        return d
 
 
 
@@ -1,6 +1,7 @@
 import cv2
 import numpy as np
 import time
+from . import rectification
 from . import tapecontours
 import math
 from scipy.spatial import distance as dist
@@ -11,7 +12,13 @@ MATRIX = np.array([[592.24710402, 0., 309.2252711],
                    [0., 0., 1.]]).astype('float32')
 
 
-def extract_points(img):
+def extract_points(img, calibration=None):
+    """Return the corners of the two pieces of tape in an image, in order.
+
+    If a calibration made by calibrate_camera.calibrate is given, the
+    corners are undistorted with it. Only the eight points are
+    undistorted rather than the whole image.
+    """
     rectangle_pair = tapecontours.get_corners_from_image(img, False)
     points = []
     temp_points = []
@@ -29,6 +36,9 @@ def extract_points(img):
     temp_points_2 = order_points(temp_points_2)
 
     points = np.array(temp_points + temp_points_2).astype('float32')
+    if calibration is not None:
+        points = rectification.undistort_points(
+            points, calibration['camera_matrix'], calibration['distance_coeffs'])
 
     return points
 
@@ -0,0 +1,151 @@
+"""
+This module contains the ParallelProcessor class, which runs an image
+processing function on several frames at once in a pool of worker
+processes, so that more than one core can be used for processing.
+
+Frames are handed to the workers through shared memory instead of being
+pickled. Each frame is copied into a free slot of shared memory and only
+the slot's number and the frame's shape are sent to the worker. Results
+can finish in any order, so they are held back and returned in the order
+the frames were submitted in.
+
+>>> processor = ParallelProcessor(process_image, (480, 640, 3))
+>>> while True:
+...     processor.submit(read_image())
+...     for seq, result in processor.ready():
+...         send(result)
+"""
+
+import logging
+import multiprocessing
+import queue
+
+import numpy as np
+
+WORKERS = max(multiprocessing.cpu_count() - 1, 1) # Leave a core for capture
+SLOTS_PER_WORKER = 2 # So workers don't wait while the next frame is copied
+
+logger = logging.getLogger(__name__)
+
+def _work(function, buffers, dtype, tasks, results):
+    """Process frames from the task queue until None is received."""
+    for task in iter(tasks.get, None):
+        seq, slot, shape = task
+        img = np.frombuffer(buffers[slot], dtype, int(np.prod(shape)))
+        try:
+            result = function(img.reshape(shape))
+        except Exception: # pylint: disable=broad-except
+            logger.exception('Error processing frame {}'.format(seq))
+            result = None
+        results.put((seq, slot, result))
+
+class ParallelProcessor(object):
+    """
+    Runs a function on frames in a pool of worker processes, returning
+    the results in the order the frames were submitted in.
+
+    The function is given a frame that is only valid until the function
+    returns, and must return something that can be pickled. Each worker
+    gets its own copy of the function, so any state it has (e.g. a
+    TapeTracker or BufferPool it is bound to) is kept separately by each
+    worker.
+
+    Frames must be of the type given when the processor is created,
+    and can have any shape as long as they are no larger than the shape
+    given.
+
+    If there are no workers, frames are processed as soon as they are
+    submitted, in the current process.
+    """
+
+    def __init__(self, function, shape, dtype=np.uint8, workers=WORKERS,
+                 slots=None, context=multiprocessing):
+        self.function = function
+        self.dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * self.dtype.itemsize
+        nslots = (slots or workers * SLOTS_PER_WORKER) if workers > 0 else 0
+
+        self._buffers = [context.RawArray('B', nbytes) for _ in range(nslots)]
+        self._free = list(range(nslots))
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._finished = {} # Results waiting for earlier frames to finish
+        self._submitted = 0 # Sequence number of the next frame to submit
+        self._next = 0 # Sequence number of the next result to return
+
+        self._workers = [context.Process(target=_work, daemon=True,
+                                         args=(function, self._buffers,
+                                               self.dtype, self._tasks,
+                                               self._results))
+                         for _ in range(workers)]
+        for w in self._workers:
+            w.start()
+
+    def _collect(self, block):
+        """Wait for a result from the workers if block is True, storing it
+        until it can be returned in order. Return False if there was no
+        result to collect."""
+        try:
+            seq, slot, result = self._results.get(block)
+        except queue.Empty:
+            return False
+        self._finished[seq] = result
+        self._free.append(slot)
+        return True
+
+    def submit(self, img):
+        """Copy a frame into shared memory and queue it to be processed,
+        returning its sequence number.
+
+        If every slot is in use, this blocks until a frame finishes.
+        """
+        if not self._workers:
+            self._finished[self._submitted] = self.function(img)
+            self._submitted += 1
+            return self._submitted - 1
+
+        while not self._free:
+            self._collect(True)
+
+        slot = self._free.pop()
+        view = np.frombuffer(self._buffers[slot], self.dtype, img.size)
+        np.copyto(view.reshape(img.shape), img, casting='no')
+
+        seq = self._submitted
+        self._submitted += 1
+        self._tasks.put((seq, slot, img.shape))
+        return seq
+
+    def pending(self):
+        """Return the number of frames submitted but not yet returned."""
+        return self._submitted - self._next
+
+    def ready(self):
+        """Return a list of (sequence number, result) tuples for the frames
+        that have finished, without waiting for any others, in order."""
+        while self._collect(False):
+            pass
+
+        ready = []
+        while self._next in self._finished:
+            ready.append((self._next, self._finished.pop(self._next)))
+            self._next += 1
+        return ready
+
+    def get(self):
+        """Wait for the next frame in order to finish and return its
+        sequence number and result."""
+        if self.pending() == 0:
+            raise ValueError('No frames have been submitted')
+        while self._next not in self._finished:
+            self._collect(True)
+        seq = self._next
+        self._next += 1
+        return seq, self._finished.pop(seq)
+
+    def close(self):
+        """Stop the workers once they finish the frames they have."""
+        for _ in self._workers:
+            self._tasks.put(None)
+        for w in self._workers:
+            w.join()
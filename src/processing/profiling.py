@@ -0,0 +1,182 @@
+"""
+Lightweight instrumentation for timing the stages of the image
+processing pipeline.
+
+Each stage keeps the durations of its last few calls in a fixed-size
+ring buffer, from which percentiles can be computed on demand. When the
+profiler is disabled, `stage` returns a context manager that does
+nothing, so leaving the instrumentation in the hot path costs very
+little. For example:
+
+>>> with PROFILER.stage('mask'):
+...     mask = get_mask(img)
+"""
+
+import json
+import threading
+import time
+
+import numpy as np
+
+RING_SIZE = 512 # Number of samples kept for each stage
+PERCENTILES = (50, 95, 99)
+
+class _NullStage(object):
+    """A context manager that does nothing, used when profiling is off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NULL_STAGE = _NullStage()
+
+class _Stage(object):
+    """A context manager that records how long its body took to run."""
+
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+        self._start = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._profiler.record(self._name, time.perf_counter() - self._start)
+        return False
+
+class RingBuffer(object):
+    """A fixed-size buffer of floats that overwrites its oldest values."""
+
+    def __init__(self, size=RING_SIZE):
+        self._data = np.zeros(size)
+        self._index = 0
+        self.count = 0 # Total number of values ever added
+
+    def append(self, value):
+        """Add a value to the buffer."""
+        self._data[self._index] = value
+        self._index = (self._index + 1) % len(self._data)
+        self.count += 1
+
+    def values(self):
+        """Return a copy of the values currently held in the buffer."""
+        return self._data[:min(self.count, len(self._data))].copy()
+
+class Profiler(object):
+    """Records the time taken by named stages of processing a frame.
+
+    Timings are only recorded while `enabled` is True. Recording and
+    querying may happen from different threads (e.g. the vision loop and
+    the server thread).
+    """
+
+    def __init__(self, size=RING_SIZE, enabled=False):
+        self.enabled = enabled
+        self._size = size
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        """Return a context manager that times the code inside it."""
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self, name, seconds):
+        """Record that a stage took the given number of seconds."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if name not in self._stages:
+                self._stages[name] = RingBuffer(self._size)
+            self._stages[name].append(seconds)
+
+    def reset(self):
+        """Forget all recorded timings."""
+        with self._lock:
+            self._stages = {}
+
+    def stats(self):
+        """Return a dictionary mapping each stage's name to statistics of
+        its recent durations, in milliseconds.
+        """
+        with self._lock:
+            samples = {k: (v.count, v.values()) for k, v in self._stages.items()}
+
+        stats = {}
+        for name, (count, values) in samples.items():
+            ms = values * 1000
+            stage = {'count': count, 'max': float(np.max(ms)),
+                     'mean': float(np.mean(ms))}
+            for p, v in zip(PERCENTILES, np.percentile(ms, PERCENTILES)):
+                stage['p{}'.format(p)] = float(v)
+            stats[name] = stage
+        return stats
+
+    def dump(self, filename):
+        """Write the current statistics to a file as JSON."""
+        with open(filename, 'w') as f:
+            json.dump(self.stats(), f, indent=2, sort_keys=True)
+
+class LatencyTracker(object):
+    """
+    Records how long each frame spends in each step between being
+    captured and having its results sent, in a Profiler.
+
+    Times are measured with time.monotonic(), which is the clock capture
+    timestamps are given in. Each call to mark records the time since
+    the frame's previous mark (or its capture) as the given stage, and
+    finish records the total time since capture. The time taken to write
+    results to each client isn't part of the total, since it happens on
+    the server's thread; aioserver.Server records it as the 'send' stage
+    of the same profiler. For example:
+
+    >>> latency.start(seq, frame.timestamp)
+    >>> latency.mark(seq, 'capture')
+    >>> result = process(frame.image)
+    >>> latency.mark(seq, 'processing')
+    >>> latency.finish(seq)
+    """
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self._frames = {} # Capture time and time of last mark of each frame
+
+    def start(self, seq, timestamp):
+        """Start tracking a frame captured at the given time."""
+        self._frames[seq] = (timestamp, timestamp)
+
+    def mark(self, seq, name, now=None):
+        """Record the time since the frame's last mark as a stage, ending
+        at the given time (from time.monotonic()) or now."""
+        captured, last = self._frames[seq]
+        if now is None:
+            now = time.monotonic()
+        self.profiler.record(name, now - last)
+        self._frames[seq] = (captured, now)
+
+    def timestamp(self, seq):
+        """Return the time the frame was captured at."""
+        return self._frames[seq][0]
+
+    def age(self, seq):
+        """Return the number of seconds since the frame was captured."""
+        return time.monotonic() - self._frames[seq][0]
+
+    def finish(self, seq, record=True):
+        """Stop tracking a frame, recording the time since it was captured
+        as the 'total' stage unless record is False."""
+        captured, _ = self._frames.pop(seq)
+        if record:
+            self.profiler.record('total', time.monotonic() - captured)
+
+# Profiler shared by the processing modules
+PROFILER = Profiler()
+
+# Profiler for the latency of frames from capture to sending their results,
+# which is always on since it's only recorded a few times per frame
+LATENCY = Profiler(enabled=True)
@@ -0,0 +1,179 @@
+"""
+This module rectifies the images of the stereo cameras, so that the tape
+is at the same height in both images and its disparity is only
+horizontal.
+
+The remap tables that rectify an image only depend on the calibration,
+so they are computed once from the calibration made by
+calibrate_stereo.calibrate, in OpenCV's fixed-point format (which remap
+uses much faster than floating-point tables), and cached on disk under
+a hash of the calibration. Only the part of each image that is valid
+after rectification (or a smaller region of interest) is remapped.
+
+When only a few points are needed (like the corners of the tape), it is
+much cheaper to find them in the raw image and then undistort or rectify
+just the points with cv2.undistortPoints, which is what undistort_points
+and Rectifier.rectify_points do.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+
+import cv2
+import numpy as np
+
+DIRNAME = os.path.dirname(os.path.realpath(__file__))
+CALIBRATION_FILE = os.path.join(DIRNAME, 'calibration.pickle')
+MAP_DIR = os.path.join(DIRNAME, 'rectmaps')
+ALPHA = 0 # 0 keeps only valid pixels after rectification, 1 keeps every pixel
+SIDES = ('left', 'right')
+
+logger = logging.getLogger(__name__)
+
+def load_calibration(filename=CALIBRATION_FILE):
+    """Return the calibration saved by calibrate_stereo.calibrate."""
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+def calibration_hash(calib, alpha=ALPHA):
+    """Return a hash of everything in a calibration that the rectification
+    depends on."""
+    h = hashlib.sha1()
+    for side in SIDES:
+        for key in ('camera_matirx', 'dist_coeffs'):
+            h.update(np.ascontiguousarray(calib[side][key], np.float64).tobytes())
+    for key in ('rot_matrix', 'trans_matrix'):
+        h.update(np.ascontiguousarray(calib[key], np.float64).tobytes())
+    h.update(repr((tuple(calib['img_size']), alpha, cv2.__version__)).encode())
+    return h.hexdigest()
+
+def undistort_points(points, camera_matrix, dist_coeffs, R=None, P=None):
+    """Return an array of the (x, y) pixel coordinates of points in an
+    image taken by a camera with the given matrix and distortion
+    coefficients, as they would be in an undistorted image.
+
+    If a rectification transform R and new projection matrix P are
+    given, the points are rectified too. Otherwise, they stay in the
+    camera's own pixel coordinates.
+    """
+    points = np.asarray(points, np.float32).reshape(-1, 1, 2)
+    P = camera_matrix if P is None else P
+    return cv2.undistortPoints(points, camera_matrix, dist_coeffs,
+                               R=R, P=P).reshape(-1, 2)
+
+class Rectifier(object):
+    """
+    Rectifies the images of a calibrated pair of stereo cameras.
+
+    The rectification transforms (R1, R2, P1, P2 and Q from
+    cv2.stereoRectify) are computed straight away, since they are cheap,
+    but the remap tables are only loaded (or computed and cached) the
+    first time an image is rectified.
+    """
+
+    def __init__(self, calib, alpha=ALPHA, map_dir=MAP_DIR):
+        self.calib = calib
+        self.size = tuple(calib['img_size']) # (width, height)
+        self.key = calibration_hash(calib, alpha)
+        self.map_dir = map_dir
+        (self.R1, self.R2, self.P1, self.P2, self.Q,
+         roi1, roi2) = cv2.stereoRectify(
+             calib['left']['camera_matirx'], calib['left']['dist_coeffs'],
+             calib['right']['camera_matirx'], calib['right']['dist_coeffs'],
+             self.size, calib['rot_matrix'], calib['trans_matrix'],
+             alpha=alpha)
+        self.rois = (roi1, roi2) # Valid (x, y, width, height) of each side
+        self._maps = None
+
+    @classmethod
+    def from_file(cls, filename=CALIBRATION_FILE, **kwargs):
+        """Return a Rectifier for the calibration saved in a file."""
+        return cls(load_calibration(filename), **kwargs)
+
+    def map_filename(self):
+        """Return the file the remap tables are cached in."""
+        return os.path.join(self.map_dir, 'rectify-{}.npz'.format(self.key))
+
+    def build_maps(self):
+        """Return the fixed-point remap tables of each side, as a list of
+        (map1, map2) tuples."""
+        maps = []
+        for side, R, P in zip(SIDES, (self.R1, self.R2), (self.P1, self.P2)):
+            maps.append(cv2.initUndistortRectifyMap(
+                self.calib[side]['camera_matirx'], self.calib[side]['dist_coeffs'],
+                R, P, self.size, cv2.CV_16SC2))
+        return maps
+
+    def maps(self):
+        """Return the remap tables of each side, loading them from the disk
+        or building them if they haven't been used yet."""
+        if self._maps is not None:
+            return self._maps
+
+        filename = self.map_filename()
+        try:
+            with np.load(filename) as data:
+                self._maps = [(data['map1_' + s], data['map2_' + s])
+                              for s in SIDES]
+        except (IOError, KeyError, ValueError):
+            logger.debug('Building rectification tables {}'.format(filename))
+            self._maps = self.build_maps()
+            arrays = {}
+            for s, (map1, map2) in zip(SIDES, self._maps):
+                arrays['map1_' + s] = map1
+                arrays['map2_' + s] = map2
+            try:
+                os.makedirs(self.map_dir, exist_ok=True)
+                # Each process writes its own file, so processes building
+                # the same tables at once don't write over each other
+                fd, tmp = tempfile.mkstemp('.npz', dir=self.map_dir)
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        np.savez(f, **arrays)
+                    os.replace(tmp, filename)
+                except:
+                    os.remove(tmp)
+                    raise
+            except OSError as e:
+                logger.error('Could not cache rectification tables: {}'
+                             .format(e))
+        return self._maps
+
+    def region(self, side):
+        """Return the region (x, y, width, height) of a side (0 for left,
+        1 for right) that is valid after rectification, or the whole image
+        if there isn't one."""
+        x, y, w, h = self.rois[side]
+        if w <= 0 or h <= 0:
+            # stereoRectify gives an empty region for poor calibrations
+            return (0, 0) + self.size
+        return x, y, w, h
+
+    def rectify_points(self, points, side):
+        """Return an array of where points found in an image from a side
+        (0 for left, 1 for right) are in the whole rectified image."""
+        calib = self.calib[SIDES[side]]
+        return undistort_points(points, calib['camera_matirx'],
+                                calib['dist_coeffs'], (self.R1, self.R2)[side],
+                                (self.P1, self.P2)[side])
+
+    def rectify(self, img, side, roi=None):
+        """Return the rectified region of interest (x, y, width, height) of
+        an image from a side (0 for left, 1 for right), which is the
+        region that is valid after rectification (or the whole image if
+        there isn't one) if none is given.
+
+        The returned image only covers the region, so a point (u, v) in
+        it is at (x + u, y + v) in the whole rectified image.
+        """
+        if (img.shape[1], img.shape[0]) != self.size:
+            raise ValueError('Image is {}x{}, but the cameras were calibrated '
+                             'at {}x{}'.format(img.shape[1], img.shape[0],
+                                               *self.size))
+        x, y, w, h = self.region(side) if roi is None else roi
+        map1, map2 = self.maps()[side]
+        return cv2.remap(img, map1[y:y + h, x:x + w], map2[y:y + h, x:x + w],
+                         cv2.INTER_LINEAR)
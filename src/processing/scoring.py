@@ -0,0 +1,133 @@
+"""
+This module finds targets by scoring every contour in an image on how
+much it looks like a piece of tape, rather than looking for two pieces
+of tape at once like tapecontours does. It contains the experiments from
+the off-season.
+"""
+
+import cv2
+import numpy as np
+
+LOW_GREEN = np.array([60, 100, 10])
+UPPER_GREEN = np.array([100, 255, 255])
+KERNEL = np.ones((2, 2), np.uint8)
+KERNEL2 = np.ones((3, 3), np.uint8)
+
+def get_mask(img, pool=None):
+    """Return a mask were the green parts of the image are white and the
+    non-green parts are black.
+
+    If a BufferPool is given, the HSV image and the mask are stored in
+    its 'hsv' and 'mask' buffers.
+    """
+    hsv = mask = None
+    if pool is not None:
+        hsv = pool.get('hsv', img.shape)
+        mask = pool.get('mask', img.shape[:2])
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV, hsv)
+    return cv2.inRange(hsv, LOW_GREEN, UPPER_GREEN, mask)
+
+def valid_cnt(cnt):
+    """Return True if the contour is possibly a valid target."""
+    area = cv2.contourArea(cnt)
+    if not area > 100:
+        return False
+
+    hullarea = cv2.contourArea(cv2.convexHull(cnt))
+    if not area/hullarea > 0.8:
+        return False
+
+    rotrect = cv2.minAreaRect(cnt)
+    w, h = rotrect[1]
+    if not min(w, h) / max(w, h) > 0.5:
+        return False
+
+    rotrectarea = w * h
+    if not area/rotrectarea > 0.7:
+        return False
+
+    return True
+
+def cnt_score(cnt):
+    """Return the score of several properties of the given contours, on a scale of 0 to 1."""
+    score = 0
+    area = cv2.contourArea(cnt)
+
+    hull = cv2.convexHull(cnt)
+    hullarea = cv2.contourArea(hull)
+    hullscore = area/hullarea
+
+    rotrect = cv2.minAreaRect(cnt)
+    w, h = rotrect[1]
+    arscore = np.sqrt(min(w, h) / max(w, h))
+
+    rotrectarea = w * h
+    rotrectscore = area / rotrectarea
+
+    perimeter = cv2.arcLength(hull, True)
+    squaredness = 1 - abs(16*hullarea / perimeter**2 - 1)**1.5
+    squarescore = squaredness
+
+    areascore = 2 / (1 + 1.1**(-area/100)) - 1
+
+    return {
+        'hull': hullscore,
+        'ar': arscore,
+        'rotrect': rotrectscore,
+        'square': squarescore,
+        'area': areascore
+    }
+
+def weighted_score(cnt):
+    """Return a total score from 0 to 1 on how likely a contour is to be a target."""
+    s = cnt_score(cnt)
+    return 0.2*s['hull'] + 0.05*s['ar'] + 0.2*s['rotrect'] + 0.35*s['square'] + 0.2*s['area']
+
+def get_best_contour(img, pool=None):
+    """Return the mask of the given image, the contours in it that could
+    be targets, and the one most likely to be a target (or None if
+    there are no valid contours).
+
+    If a BufferPool is given, the mask and the images made from it are
+    stored in it instead of being allocated for every image.
+    """
+    mask = get_mask(img, pool)
+    closing = opening = None
+    if pool is not None:
+        closing = pool.get('closing', mask.shape)
+        opening = pool.get('opening', mask.shape)
+    closing = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, KERNEL, closing,
+                               iterations=2)
+    opening = cv2.morphologyEx(closing, cv2.MORPH_OPEN, KERNEL2, opening,
+                               iterations=4)
+
+    _, cnt, _ = cv2.findContours(opening, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    valid = list(filter(valid_cnt, cnt))
+
+    bestcnt = max(valid, key=weighted_score) if len(valid) > 0 else None
+    return mask, valid, bestcnt
+
+def get_corners(mask, bestcnt):
+    """Return the bounding box (x, y, width, height) of the target whose
+    contour is given, refined using the mask it was found in.
+    """
+    bbx, bby, bbw, bbh = cv2.boundingRect(bestcnt)
+    roi = mask[bby:bby+bbh, bbx:bbx+bbw]
+
+    roi2 = cv2.morphologyEx(roi, cv2.MORPH_OPEN, KERNEL2, iterations=6)
+    bbbx, bbby, _, _ = cv2.boundingRect(roi2)
+    return (bbx+bbbx, bby+bbby, bbw, bbh)
+
+def bbox_points(bbox):
+    """Return the corners of a bounding box (x, y, width, height) as a
+    list of (x, y) points, clockwise from the top left."""
+    x, y, w, h = (int(v) for v in bbox)
+    return [(x, y), (x + w, y), (x + w, y + h), (x, y + h)]
+
+def get_target(img, pool=None):
+    """Return the bounding box of the target in an image (or None if
+    there isn't one) and a list of the points of every contour that
+    could be a target."""
+    mask, valid, bestcnt = get_best_contour(img, pool)
+    corners = get_corners(mask, bestcnt) if bestcnt is not None else None
+    return corners, [cnt.tolist() for cnt in valid]
@@ -1,10 +1,12 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 import time
 from . import tapecontours
 import math
-import pickle
 from . import calibrate_camera
+from . import rectification
 import logging
 
 CAMERA_MATRIX = np.array([[592.24710402, 0., 309.2252711],
@@ -14,6 +16,28 @@ CAMERA_MATRIX = np.array([[592.24710402, 0., 309.2252711],
 
 camera_dist = 0
 
+BASELINE = 7.25 # Inches between the cameras' lenses
+FOCAL_LENGTH = 585 # Focal length of the cameras, in pixels
+# Distances found from the disparity alone are corrected with this line,
+# which was fitted against measured distances
+DISTANCE_SCALE = 1.8174
+DISTANCE_OFFSET = -8.1707
+CENTER_X = 240 # Middle column of the (rotated) images
+MAX_DEVIATION = 3 # Corners whose depth is further than this many median
+                  # absolute deviations from the median depth are outliers
+
+logger = logging.getLogger(__name__)
+
+# The result of processing a pair of images. distance is the mean depth of
+# the corners that aren't outliers, offset is how far left of the middle
+# of the images the tape is (in pixels), depths has the depth of every
+# corner, valid says which corners aren't outliers and residual is the
+# root mean square error (in pixels) of the matched corners, which is
+# their vertical disparity (as the images should be rectified) or their
+# reprojection error if they were triangulated.
+StereoResult = namedtuple('StereoResult', ['distance', 'offset', 'depths',
+                                           'residual', 'valid'])
+
 # left_dict = calibrate_camera.calibrate(
 #     r'processing/left_images/*', r"processing/calibration.pickle.left")
 # right_dict = calibrate_camera.calibrate(
@@ -30,34 +54,100 @@ camera_dist = 0
 # with open("processing/calibration.pickle", "rb") as p:
 #     calib_dict = pickle.load(p)
 
-with open("src/processing/calibration.pickle", "rb") as p:
-    calib_dict = pickle.load(p)
-
-def process(left_img, right_img, show_image=False):
-
-    # R1, R2, P1, P2, Q, roi1, roi2 = cv2.stereoRectify(cameraMatrix1=calib_dict["left"]["camera_matirx"], distCoeffs1=calib_dict["left"]["dist_coeffs"],
-    #                                                  cameraMatrix2=calib_dict["right"]["camera_matirx"], distCoeffs2=calib_dict["right"]["dist_coeffs"],
-    #                                                  imageSize=calib_dict["img_size"], R=calib_dict["rot_matrix"], T=calib_dict["trans_matrix"])
-    #
-    # left_maps = cv2.initUndistortRectifyMap(calib_dict["left"]["camera_matirx"], calib_dict["left"]["dist_coeffs"], R1, P1, (640, 480),
-    #                                         cv2.CV_16SC2)
-    # right_maps = cv2.initUndistortRectifyMap(calib_dict["right"]["camera_matirx"], calib_dict["right"]["dist_coeffs"], R2, P2, (640, 480),
-    #                                          cv2.CV_16SC2)
-
-
-
-
- #    P1 = np.array([[   1.,           0.,          108.48160885,    0.        ],
- # [   0.,            1.,          -10.66847563,    0.        ],
- # [   0.,            0.,            1.,            0.        ]])
- #    P2 = np.array([[   1.,            0.,          108.48160885,    8.1559507 ],
- # [   0.,            1.,          -10.66847563,    0.        ],
- # [   0.,            0.,            1.,            0.        ]])
- #   # print(P1, P2)
- #
- #
- #    left_img_remap = cv2.remap(left_img, left_maps[0], left_maps[1], cv2.INTER_LANCZOS4)
- #    right_img_remap = cv2.remap(right_img, right_maps[0], right_maps[1], cv2.INTER_LANCZOS4)
+calib_dict = rectification.load_calibration()
+RECTIFIER = rectification.Rectifier(calib_dict)
+
+# Ways process can rectify images
+RECTIFY_IMAGES = 'images' # Remap the images before searching them
+RECTIFY_POINTS = 'points' # Search the raw images and only rectify the corners
+
+# Thread the left image is searched on while the right one is searched on
+# the calling thread. OpenCV releases the GIL, so the two run on separate
+# cores.
+_detector = ThreadPoolExecutor(max_workers=1)
+
+def get_corners_from_pair(left_img, right_img, show_image=False, parallel=True):
+    """Return the corners found in the left and right images, searching
+    both images at once if parallel is True.
+
+    Images are only shown from the calling thread, so they are searched
+    one after the other when show_image is True.
+    """
+    if not parallel or show_image:
+        return (tapecontours.get_corners_from_image(left_img, 1, show_image=show_image),
+                tapecontours.get_corners_from_image(right_img, 2, show_image=show_image))
+    left = _detector.submit(tapecontours.get_corners_from_image, left_img, 1,
+                            show_image=False)
+    right = tapecontours.get_corners_from_image(right_img, 2, show_image=False)
+    return left.result(), right
+
+def reject_outliers(depths, max_deviation=MAX_DEVIATION):
+    """Return an array saying which depths are positive and within
+    max_deviation median absolute deviations of the median depth."""
+    valid = np.isfinite(depths) & (depths > 0)
+    if not np.any(valid):
+        return valid
+    median = np.median(depths[valid])
+    deviation = np.abs(depths - median)
+    mad = np.median(deviation[valid])
+    return valid & (deviation <= max_deviation * max(mad, 1e-6 * median))
+
+def triangulate(corners_left, corners_right, P1=None, P2=None):
+    """Return a StereoResult for matching arrays of corners from the left
+    and right images.
+
+    If the projection matrices of the rectified cameras are given, the
+    corners are triangulated with them (and depths are in the units of
+    the calibration), and the distance is their mean depth. Otherwise,
+    depths are found from the disparity of each corner, in inches, and
+    the distance is found from their mean disparity.
+    """
+    left = np.asarray(corners_left, np.float64).reshape(-1, 2)
+    right = np.asarray(corners_right, np.float64).reshape(-1, 2)
+
+    if P1 is None or P2 is None:
+        disparity = np.abs(left[:, 0] - right[:, 0])
+        with np.errstate(divide='ignore'):
+            depths = BASELINE * FOCAL_LENGTH / disparity
+        residual = np.sqrt(np.mean((left[:, 1] - right[:, 1]) ** 2))
+    else:
+        points = cv2.triangulatePoints(P1, P2, left.T, right.T)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            points = points[:3] / points[3]
+            depths = points[2]
+            # Project the points back into both images to see how far they
+            # are from where they were found
+            homogeneous = np.vstack([points, np.ones(len(left))])
+            errors = [P.dot(homogeneous) for P in (P1, P2)]
+            errors = np.hstack([e[:2] / e[2] - observed.T
+                                for e, observed in zip(errors, (left, right))])
+        residual = np.sqrt(np.mean(errors ** 2))
+
+    valid = reject_outliers(depths)
+    if not np.any(valid):
+        return StereoResult(float('nan'), float('nan'), depths,
+                            float(residual), valid)
+    if P1 is None or P2 is None:
+        # The correction was fitted to the depth of the mean disparity,
+        # which isn't the mean depth since depth is 1 / disparity
+        distance = BASELINE * FOCAL_LENGTH / np.mean(disparity[valid])
+        distance = DISTANCE_SCALE * distance + DISTANCE_OFFSET
+    else:
+        distance = np.mean(depths[valid])
+    offset = CENTER_X - np.mean((left[valid, 0] + right[valid, 0]) / 2)
+    return StereoResult(float(distance), float(offset), depths,
+                        float(residual), valid)
+
+def process(left_img, right_img, show_image=False, parallel=True, rectify=None):
+    """Return a StereoResult for the tape in a pair of images, or None if
+    the tape couldn't be found in both."""
+    # Only the valid part of each image is rectified, so corners found in
+    # it are offset by where that part starts
+    offsets = [np.zeros(2), np.zeros(2)]
+    if rectify == RECTIFY_IMAGES:
+        left_img = RECTIFIER.rectify(left_img, 0)
+        right_img = RECTIFIER.rectify(right_img, 1)
+        offsets = [np.array(RECTIFIER.region(side)[:2]) for side in (0, 1)]
 
     if show_image:
         cv2.imshow('left', left_img)
@@ -66,49 +156,25 @@ def process(left_img, right_img, show_image=False):
 
 
     try:
-        corners_left = np.concatenate(tapecontours.get_corners_from_image(left_img, 1, show_image=show_image))
-        corners_right = np.concatenate(tapecontours.get_corners_from_image(right_img, 2, show_image=show_image))
-    except Exception as e:
-        return
+        corners_left, corners_right = get_corners_from_pair(left_img, right_img,
+                                                           show_image, parallel)
+        corners_left = np.concatenate(corners_left) + offsets[0]
+        corners_right = np.concatenate(corners_right) + offsets[1]
+        if rectify == RECTIFY_POINTS:
+            corners_left = RECTIFIER.rectify_points(corners_left, 0)
+            corners_right = RECTIFIER.rectify_points(corners_right, 1)
+    except Exception: # pylint: disable=broad-except
+        return None
     if len(corners_left) != 8 or len(corners_right) != 8:
-        #print(corners_left)
-        #print(corners_right)
-        print("did not werk")
-        return
-
-    reconstructed_points = []
-    point_pairs = zip(list(corners_left), list(corners_right))
-    average_disp = 0
-    average_x = 0
-    for point_pair in point_pairs:
-        # print(point_pair)
-        print(point_pair[0][1])
-        sub_average = (point_pair[0][0] + point_pair[1][0])/2
-        average_x = average_x + sub_average
-        disparity = abs(point_pair[0][0] - point_pair[1][0])
-        average_disp = average_disp + disparity
-    disparity = average_disp/8
-    average_x = average_x/8
-    average_x = average_x - 240
-    average_x = - average_x
-    # print(average_x)
-    # print(average_x-240)
-    # print("Disparity: {}".format(disparity))
-    distance = (7.25*585)/disparity
-    # print("Dist: " + str(distance))
-    true_dist = y = 1.8174*distance - 8.1707
-
-
-
-        # focal length is in camera matrix (fx)
-    # Z = (b * f) / (x1 - x2)
-    # b = distance between lens
-    # distance =  (camera_dist_between_lenses*focal length)/(disparity)
-
-
-    # z = triangulation_constant / dispartity
-
-    return (true_dist, average_x)
+        logger.debug('Found {} left and {} right corners'.format(
+            len(corners_left), len(corners_right)))
+        return None
+
+    # Triangulating needs the rectified cameras' projection matrices, which
+    # only describe the corners if they were rectified
+    if rectify is None:
+        return triangulate(corners_left, corners_right)
+    return triangulate(corners_left, corners_right, RECTIFIER.P1, RECTIFIER.P2)
 
 if __name__ == '__main__':
     print("Running main from stereo")
@@ -0,0 +1,123 @@
+"""
+This module contains the StereoCapture class, which reads pairs of frames
+from two cameras that were captured at (nearly) the same time.
+
+Reading one camera and then the other can give frames tens of
+milliseconds apart, which is enough for the disparity between them to
+be meaningless while the robot is moving. Instead, each camera is read
+on its own thread by a VideoCapture, which timestamps every frame as it
+is grabbed, and frames are paired by their timestamps. Frames that
+don't have a partner within the tolerance are dropped and counted.
+
+>>> stereo = StereoCapture(VideoCapture(0), VideoCapture(1))
+>>> stereo.start()
+>>> while True:
+...     pair = stereo.read_pair()
+...     process(pair.left.image, pair.right.image)
+"""
+
+from collections import deque, namedtuple
+import time
+
+SYNC_TOLERANCE = 0.01 # Most seconds between the frames of a pair
+HISTORY = 8 # Number of unpaired frames kept from each camera
+
+# Two Frames from the videocapture module captured at about the same time
+StereoPair = namedtuple('StereoPair', ['left', 'right'])
+
+class StereoCapture(object):
+    """
+    Pairs the frames read by two captures, which are started and stopped
+    together. The captures can be anything with a read_frame method like
+    VideoCapture's.
+
+    Each pair is made of the newest frames whose timestamps are within
+    tolerance seconds of each other. Frames older than a pair, or too
+    old to ever be paired, are dropped and counted in dropped.
+    """
+
+    def __init__(self, left, right, tolerance=SYNC_TOLERANCE, history=HISTORY):
+        self.captures = (left, right)
+        self.tolerance = tolerance
+        self.pairs = 0 # Number of pairs read
+        self.dropped = 0 # Number of frames dropped without being paired
+        self._frames = (deque(), deque()) # Unpaired frames from each camera
+        self._history = history
+        self._seqs = [None, None] # Sequence number of the last frame read
+
+    def start(self):
+        """Start reading from both cameras."""
+        for capture in self.captures:
+            capture.start()
+
+    def stop(self):
+        """Stop reading from both cameras."""
+        for capture in self.captures:
+            capture.stop()
+
+    def _add(self, side, frame):
+        """Add a frame from a camera, dropping the oldest if there are too
+        many."""
+        frames = self._frames[side]
+        frames.append(frame)
+        if len(frames) > self._history:
+            frames.popleft()
+            self.dropped += 1
+
+    def _drop_older(self, side, timestamp):
+        """Drop the frames from a camera captured before a time."""
+        frames = self._frames[side]
+        while frames and frames[0].timestamp < timestamp:
+            frames.popleft()
+            self.dropped += 1
+
+    def _match(self):
+        """Return the newest pair of frames within the tolerance, removing
+        them and every older frame, or None if there isn't one."""
+        left, right = self._frames
+        if not left or not right:
+            return None
+
+        for l in reversed(left):
+            r = min(right, key=lambda f: abs(f.timestamp - l.timestamp))
+            if abs(r.timestamp - l.timestamp) <= self.tolerance:
+                self._drop_older(0, l.timestamp)
+                self._drop_older(1, r.timestamp)
+                left.popleft()
+                right.popleft()
+                self.pairs += 1
+                return StereoPair(l, r)
+
+        # Frames from either camera will only get newer, so frames too far
+        # behind the other camera's newest frame will never be paired
+        newest = left[-1].timestamp, right[-1].timestamp
+        self._drop_older(0, newest[1] - self.tolerance)
+        self._drop_older(1, newest[0] - self.tolerance)
+        return None
+
+    def read_pair(self, timeout=None):
+        """Return the next StereoPair, waiting for up to timeout seconds (or
+        forever if it is None) for frames that can be paired.
+
+        None is returned if the timeout runs out.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            pair = self._match()
+            if pair is not None:
+                return pair
+
+            # Wait for the camera that is behind, since only a newer frame
+            # from it can match the other camera's newest frame
+            left, right = self._frames
+            side = 0 if not left or (right and
+                                     left[-1].timestamp <= right[-1].timestamp) else 1
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+            frame = self.captures[side].read_frame(remaining, self._seqs[side])
+            if frame is None:
+                return None
+            self._seqs[side] = frame.seq
+            if frame.status:
+                self._add(side, frame)
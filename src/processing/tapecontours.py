@@ -4,10 +4,10 @@ These pieces of tape are assumed to be quadrilaterals, and should not
 intersect each other.
 """
 
-from functools import partial
 import cv2
 import numpy as np
 from .drawing import draw_corners
+from .profiling import PROFILER
 
 LOW_GREEN = np.array([40, 85, 100])
 UPPER_GREEN = np.array([100, 255, 255])
@@ -90,13 +90,29 @@ def get_distance(cnt, center):
     ydiff = center[1] - cnt_center[1]
     return np.sqrt(xdiff**2 + ydiff**2)
 
-def get_mask(img):
+def get_mask(img, pool=None):
     """Return a mask were the green parts of the image are white and the
     non-green parts are black.
+
+    If a BufferPool is given, the HSV image and the mask are stored in
+    its 'hsv' and 'mask' buffers.
     """
-    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-    mask = cv2.inRange(hsv, LOW_GREEN, UPPER_GREEN)
-    return mask
+    with PROFILER.stage('mask'):
+        hsv = mask = None
+        if pool is not None:
+            hsv = pool.get('hsv', img.shape)
+            mask = pool.get('mask', img.shape[:2])
+        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV, hsv)
+        return cv2.inRange(hsv, LOW_GREEN, UPPER_GREEN, mask)
+
+def copy_image(img, pool=None):
+    """Return a copy of an image, stored in the 'debug' buffer of the
+    given BufferPool if there is one."""
+    if pool is None:
+        return img.copy()
+    debug_img = pool.get('debug', img.shape, img.dtype)
+    np.copyto(debug_img, img)
+    return debug_img
 
 def color_contour(contour, n, img):
     """
@@ -115,25 +131,126 @@ def color_contour(contour, n, img):
             red = 255 - n * 51
         cv2.drawContours(img, [contour], -1, (0, green, red), 1)
 
-def is_tape(contour, debug_img=None):
+class ContourFeatures(object):
+    """
+    A table of the properties of every contour found in a frame.
+
+    Each contour's area, bounding rect, min area rect, center and
+    perimeter are computed once and stored in arrays, so that the
+    criteria for being a piece of tape can be checked for all of the
+    contours at once instead of calling OpenCV for every check.
     """
-    Return true if the given contour could represent a piece of tape,
-    otherwise return false.
+
+    def __init__(self, contours):
+        n = len(contours)
+        self.contours = contours
+        self.area = np.zeros(n)
+        self.rect = np.zeros((n, 4), np.int32) # x, y, w, h
+        self.rot_size = np.zeros((n, 2)) # w, h of the min area rect
+        self.center = np.full((n, 2), -1e4) # See get_center
+        self.perimeter = np.zeros(n)
+        self._approx = {}
+
+        if n > 0:
+            self._compute_features()
+
+        # Criteria 2: Contour's area is at least 70% of that of the
+        # bounding rect
+        self.bound_ok = ((self.area != 0) &
+                         (self.area / self.rect[:, 2] / self.rect[:, 3]
+                          >= BOUND_MIN_PERCENT))
+
+        # The min area rect is only needed for contours that pass the
+        # bounding rect check, and is by far the most expensive to compute
+        for i in np.flatnonzero(self.bound_ok):
+            self.rot_size[i] = cv2.minAreaRect(contours[i])[1]
+
+        rw, rh = self.rot_size.T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Criteria 3: Contour's area is at least 80% of the min area rect
+            self.rot_ok = self.bound_ok & (self.area / rw / rh >= ROT_MIN_PERCENT)
+            # Criteria 4: % error between actual aspect ratio and expected
+            # is <= 60%. Since w will usually be less but h won't, the
+            # ratio should be less
+            ratio = np.minimum(rw/rh, rh/rw)
+            err = (TAPE_WH_RATIO - ratio) / TAPE_WH_RATIO
+            self.ratio_ok = np.abs(err) < TAPE_ACCEPTABLE_ERROR
+        self.shape_ok = self.rot_ok & self.ratio_ok
+
+    def _compute_features(self):
+        """Compute the area, center, bounding rect and perimeter of all of
+        the contours at once.
+
+        All of the contours' points are put in one array, and the sums
+        over each contour's edges are found with `np.add.reduceat`. This
+        gives exactly the same results as cv2.moments, cv2.boundingRect
+        and cv2.arcLength since the points have integer coordinates.
+        """
+        counts = np.array([len(c) for c in self.contours])
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        points = np.concatenate(self.contours).reshape(-1, 2)
+
+        # Each point is paired with the next one in its contour, with the
+        # last point in a contour wrapping around to the first
+        following = np.arange(1, len(points) + 1)
+        following[starts + counts - 1] = starts
+
+        x, y = points.T.astype(np.float64)
+        xn, yn = x[following], y[following]
+
+        # Shoelace formula for the area and first order moments, using the
+        # same constants as cv2.moments
+        cross = x * yn - xn * y
+        a00 = np.add.reduceat(cross, starts)
+        a10 = np.add.reduceat(cross * (x + xn), starts)
+        a01 = np.add.reduceat(cross * (y + yn), starts)
+        sign = np.where(a00 < 0, -1, 1)
+        self.area = a00 * 0.5 * sign
+        m10 = a10 * 0.16666666666666666 * sign
+        m01 = a01 * 0.16666666666666666 * sign
+        nonzero = self.area != 0
+        self.center[nonzero, 0] = np.trunc(m10[nonzero] / self.area[nonzero])
+        self.center[nonzero, 1] = np.trunc(m01[nonzero] / self.area[nonzero])
+
+        xmin = np.minimum.reduceat(points[:, 0], starts)
+        ymin = np.minimum.reduceat(points[:, 1], starts)
+        self.rect[:, 0] = xmin
+        self.rect[:, 1] = ymin
+        self.rect[:, 2] = np.maximum.reduceat(points[:, 0], starts) - xmin + 1
+        self.rect[:, 3] = np.maximum.reduceat(points[:, 1], starts) - ymin + 1
+
+        # cv2.arcLength finds the length of each edge in single precision
+        dx = (xn - x).astype(np.float32)
+        dy = (yn - y).astype(np.float32)
+        lengths = np.sqrt(dx*dx + dy*dy).astype(np.float64)
+        self.perimeter = np.add.reduceat(lengths, starts)
+
+    def __len__(self):
+        return len(self.contours)
+
+    def approx(self, i):
+        """Return the polygon approximating the contour at index i."""
+        if i not in self._approx:
+            self._approx[i] = cv2.approxPolyDP(self.contours[i],
+                                               0.04 * self.perimeter[i], True)
+        return self._approx[i]
+
+def is_tape(features, i, debug_img=None):
+    """
+    Return true if the contour at index i of the given ContourFeatures
+    could represent a piece of tape, otherwise return false.
 
     This function also returns the bounding rect points upon success.
     """
-    rect = cv2.boundingRect(contour)
-    rot_rect = cv2.minAreaRect(contour)
-    area = cv2.contourArea(contour)
-    perimeter = cv2.arcLength(contour, True)
-    approx = cv2.approxPolyDP(contour, 0.04 * perimeter, True)
+    contour = features.contours[i]
+    approx = features.approx(i)
 
     color_contour(contour, 2, debug_img)
 
     # Criteria 1: Contour has 4 or 5 contours
-    center = get_center(contour)
-    moved_center = (int(center[0]-5), int(center[1]+5))
     if debug_img is not None:
+        center = features.center[i]
+        moved_center = (int(center[0]-5), int(center[1]+5))
         cv2.putText(debug_img, str(len(approx)), moved_center,
                     cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255))
 
@@ -143,28 +260,16 @@ def is_tape(contour, debug_img=None):
         return False, None
 
     color_contour(contour, 3, debug_img)
-
-    # Criteria 2: Contour's area is at least 70% of that of the bounding rect
-    x, y, w, h = rect
-    if area == 0 or area / w / h < BOUND_MIN_PERCENT:
+    if not features.bound_ok[i]:
         return False, None
 
     color_contour(contour, 4, debug_img)
-
-    # Criteria 3: Contour's area is at least 80% of the min area rect
-    _, (rw, rh), _ = rot_rect
-    if area == 0 or area / rw / rh < ROT_MIN_PERCENT:
+    if not features.rot_ok[i]:
         return False, None
 
     color_contour(contour, 5, debug_img)
-
-    # Critera 3: % error between actual aspect ratio and expected is <= 70%
-    ratio = min(rw/rh, rh/rw) # w/h ratio since w will always be less than h
-
-    # Since w will usually be less but h won't, the ratio should be less
-    err = (TAPE_WH_RATIO - ratio) / TAPE_WH_RATIO
-
-    if abs(err) < TAPE_ACCEPTABLE_ERROR:
+    if features.ratio_ok[i]:
+        x, y, w, h = (int(v) for v in features.rect[i])
         points = [[(x, y+h)], [(x, y)], [(x+w, y)], [(x+w, y+h)]]
         # One could also return approx instead of points but approx is not
         # always accurate
@@ -172,92 +277,120 @@ def is_tape(contour, debug_img=None):
 
     return False, None
 
-def large_tape_piece(contours, tape_cnt=None, tape_area=None, debug_img=None):
+def large_tape_piece(features, order, tape_area=None, tape_height=None,
+                     debug_img=None):
     """
-    Return the contours and corners for the piece of tape in the given
-    set of contours. If none of the contours are close enough to a piece
-    of tape, return None in place of the contours and None in place of
-    the corners.
-
-    This function also returns an array of the rest of the contours that
-    are yet unprocessed.
+    Return the index and corners for the piece of tape among the
+    contours in the given ContourFeatures, checking the indices in the
+    given order. If none of the contours are close enough to a piece of
+    tape, return None in place of the index and None in place of the
+    corners.
+
+    If the area and height of a previously found piece of tape are
+    given, stop checking once a contour's area or height differs too
+    much from it.
+
+    This function also returns an array of the indices of the rest of
+    the contours that are yet unprocessed.
     """
-    rest = [c for c in contours]
-
-    for c in contours[:10]:
-        if tape_cnt is not None and tape_area is not None:
-            err1 = abs(cv2.contourArea(c) - tape_area) / tape_area
-            err2 = (abs(cv2.boundingRect(c)[3] - cv2.boundingRect(tape_cnt)[3])
-                    / tape_area)
-
-            color_contour(c, 0, debug_img)
-            if err1 > MAX_AREA_ERROR:
-                break
-            color_contour(c, 1, debug_img)
-            if err2 > MAX_HEIGHT_ERROR:
-                break
-
-        rest = rest[1:]
-
-        tape, approx = is_tape(c, debug_img)
+    checked = np.asarray(order[:10], np.intp)
+    stop = len(checked)
+    compare = tape_area is not None and tape_height is not None
+
+    if compare:
+        err1 = np.abs(features.area[checked] - tape_area) / tape_area
+        err2 = np.abs(features.rect[checked, 3] - tape_height) / tape_area
+        failed = np.flatnonzero((err1 > MAX_AREA_ERROR) |
+                                (err2 > MAX_HEIGHT_ERROR))
+        if len(failed) > 0:
+            stop = failed[0]
+
+    for n, i in enumerate(checked[:stop+1]):
+        if debug_img is not None and compare:
+            color_contour(features.contours[i], 0, debug_img)
+            if err1[n] <= MAX_AREA_ERROR:
+                color_contour(features.contours[i], 1, debug_img)
+        if n == stop:
+            break
+
+        # Only contours that are drawn need to go through is_tape if they
+        # are already known to have the wrong shape
+        if debug_img is None and not features.shape_ok[i]:
+            continue
+
+        tape, approx = is_tape(features, i, debug_img)
         if tape:
-            return c, corners_to_tuples(approx), rest
+            return i, corners_to_tuples(approx), order[n+1:]
 
-    return None, None, rest
+    return None, None, order[stop:]
 
-def split_tape_piece(contours, tape_cnt=None, tape_area=None, debug_img=None):
+def split_tape_piece(features, order, tape_area=None, tape_center=None,
+                     tape_height=None, debug_img=None):
     """
-    Return the contours and corners for the piece of tape in the given
-    set of contours, created by combining the two largest contours. If
-    none of the contours are close enough to a piece of tape, return
-    None in place of the contours and None in place of the corners.
+    Return the contours and corners for the piece of tape among the
+    contours in the given ContourFeatures whose indices are given,
+    created by combining the two largest contours. If none of the
+    contours are close enough to a piece of tape, return None in place
+    of the contours and None in place of the corners.
     """
-    if tape_cnt is not None and tape_area is not None:
-        distance = partial(get_distance, center=get_center(tape_cnt))
-        err = lambda c: abs(cv2.contourArea(c) - tape_area) / tape_area
-        cmb = lambda c: distance(c)**0.1 * err(c)**10
-
-        # Find all contours with high enough area and sort them by distance
-        # from the previously found piece of tape
-        other_cnt = sorted(contours, key=cmb)
-    else:
-        other_cnt = contours
-
-    if len(other_cnt) >= 2:
-        combined_cnt = cv2.convexHull(
-            np.concatenate((other_cnt[0], other_cnt[1])))
-        cmb_cnt, cmb_corns, _ = large_tape_piece([combined_cnt], tape_cnt,
-                                                 tape_area, debug_img)
-        return cmb_cnt, cmb_corns
-        # if cmb_cnt is not None:
-        #     rest = []
-        #     for cnt in contours:
-        #         if cnt is not other_cnt[0] and cnt is not other_cnt[1]:
-        #             rest.append(cnt)
-        #     return cmb_cnt, cmb_corns, rest
-
-    return None, None
-
-def get_tape_contours_and_corners(mask, debug_img=None):
+    if len(order) < 2:
+        return None, None
+
+    if tape_area is not None and tape_center is not None:
+        # Sort the contours by how close they are to the previously found
+        # piece of tape, both in area and distance
+        xdiff, ydiff = (np.asarray(tape_center) - features.center[order]).T
+        distance = np.sqrt(xdiff**2 + ydiff**2)
+        err = np.abs(features.area[order] - tape_area) / tape_area
+        cmb = distance**0.1 * err**10
+        order = np.asarray(order)[np.argsort(cmb, kind='stable')]
+
+    combined_cnt = cv2.convexHull(
+        np.concatenate((features.contours[order[0]],
+                        features.contours[order[1]])))
+    combined = ContourFeatures([combined_cnt])
+    index, corners, _ = large_tape_piece(combined, [0], tape_area,
+                                         tape_height, debug_img)
+    if index is None:
+        return None, None
+    return combined_cnt, corners
+
+def get_tape_contours_and_corners(mask, debug_img=None, offset=(0, 0)):
     """Return an array of contours for the pieces of tape in a given
-    mask as well as the corners for each of those contours."""
+    mask as well as the corners for each of those contours.
+
+    If the mask only covers part of an image, the offset of its top left
+    corner in the image can be given so that the contours and corners
+    are returned in the coordinates of the whole image (which is also
+    what debug_img should be).
+    """
+
+    with PROFILER.stage('find_contours'):
+        _, cnt, _ = cv2.findContours(mask, cv2.RETR_TREE,
+                                     cv2.CHAIN_APPROX_SIMPLE,
+                                     offset=tuple(offset))
 
-    _, cnt, _ = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    with PROFILER.stage('features'):
+        features = ContourFeatures(cnt)
 
-    sorted_contours = sorted(cnt, key=cv2.contourArea, reverse=True)
+    with PROFILER.stage('sort'):
+        # Largest first, keeping the order of contours with equal area
+        sorted_indices = np.argsort(-features.area, kind='stable')
     found_contours = []
     found_corners = []
 
-    tape_cnt, tape_crn, rest = large_tape_piece(sorted_contours,
+    with PROFILER.stage('is_tape'):
+        tape, tape_crn, rest = large_tape_piece(features, sorted_indices,
                                                 debug_img=debug_img)
 
-    if tape_cnt is not None and cv2.contourArea(tape_cnt) > 0:
-        found_contours.append(tape_cnt)
+    if tape is not None and features.area[tape] > 0:
+        found_contours.append(features.contours[tape])
         found_corners.append(tape_crn)
 
-        tcx, tcy = get_center(tape_cnt)
+        tcx, tcy = features.center[tape]
+        tape_height = features.rect[tape, 3]
 
-        area = cv2.contourArea(tape_cnt)
+        area = features.area[tape]
         asqrt = np.sqrt(area)
         percent_size = np.sqrt(area / (TAPE_WIDTH*TAPE_HEIGHT))
         exact_range = TARGET_WIDTH * percent_size
@@ -274,20 +407,19 @@ def get_tape_contours_and_corners(mask, debug_img=None):
                           (int(tcx+x_range), int(tcy+y_range)),
                           (0, 150, 0), 1)
 
-        rest_left = []
-        rest_right = []
-
-        for c in sorted_contours:
-            cx, cy = get_center(c)
-            iny = tcy - y_range < cy < tcy + y_range
-            if c is not tape_cnt and iny:
-                if tcx - x_range < cx < tcx - asqrt * MIN_PAD:
-                    rest_left.append(c)
-                if tcx + asqrt * MIN_PAD < cx < tcx + x_range:
-                    rest_right.append(c)
+        cx, cy = features.center[sorted_indices].T
+        iny = ((tcy - y_range < cy) & (cy < tcy + y_range) &
+               (sorted_indices != tape))
+        left = (tcx - x_range < cx) & (cx < tcx - asqrt * MIN_PAD)
+        right = (tcx + asqrt * MIN_PAD < cx) & (cx < tcx + x_range)
+        rest_left = sorted_indices[iny & left]
+        rest_right = sorted_indices[iny & right]
 
-        lcnt, lcrn = split_tape_piece(rest_left, tape_cnt, area, debug_img=debug_img)
-        rcnt, rcrn = split_tape_piece(rest_right, tape_cnt, area, debug_img=debug_img)
+        with PROFILER.stage('split_tape_piece'):
+            lcnt, lcrn = split_tape_piece(features, rest_left, area,
+                                          (tcx, tcy), tape_height, debug_img)
+            rcnt, rcrn = split_tape_piece(features, rest_right, area,
+                                          (tcx, tcy), tape_height, debug_img)
 
         # I don't know how to compare things so I'm going with the left one
         if lcnt is None:
@@ -298,10 +430,10 @@ def get_tape_contours_and_corners(mask, debug_img=None):
             found_contours.append(lcnt)
             found_corners.append(lcrn)
         else:
-            t2_cnt, t2_crn, _ = large_tape_piece(rest, tape_cnt, area,
-                                                 debug_img=debug_img)
-            if t2_cnt is not None:
-                found_contours.append(t2_cnt)
+            t2, t2_crn, _ = large_tape_piece(features, rest, area,
+                                             tape_height, debug_img)
+            if t2 is not None:
+                found_contours.append(features.contours[t2])
                 found_corners.append(t2_crn)
 
     if debug_img is not None:
@@ -311,16 +443,23 @@ def get_tape_contours_and_corners(mask, debug_img=None):
 
     return found_contours, found_corners
 
-def get_corners_from_image(img, n='', show_image=DEBUG):
-    """Return an array of the corners of the tape in a given image."""
-    debug_img = img.copy() if show_image else None
+def get_corners_from_image(img, n='', show_image=DEBUG, pool=None):
+    """Return an array of the corners of the tape in a given image.
 
-    mask = get_mask(img)
-    if show_image:
-        cv2.imshow('mask{}'.format(n), mask)
-    _, crns = get_tape_contours_and_corners(mask, debug_img)
-
-    if show_image:
-        cv2.imshow('corners{}'.format(n), debug_img)
+    If a BufferPool is given, the images made while processing are
+    stored in it instead of being allocated for every image.
+    """
+    with PROFILER.stage('total'):
+        debug_img = None
+        if show_image:
+            debug_img = copy_image(img, pool)
+
+        mask = get_mask(img, pool)
+        if show_image:
+            cv2.imshow('mask{}'.format(n), mask)
+        _, crns = get_tape_contours_and_corners(mask, debug_img)
+
+        if show_image:
+            cv2.imshow('corners{}'.format(n), debug_img)
 
     return crns
@@ -0,0 +1,111 @@
+"""
+This module tracks the tape from frame to frame. Since the tape barely
+moves between frames, only a region around where it was last found
+needs to be searched, which is much faster than searching the whole
+image.
+"""
+
+import cv2
+import numpy as np
+from .buffers import BufferPool
+from .profiling import PROFILER
+from .tapecontours import (copy_image, get_mask, get_tape_contours_and_corners,
+                           DEBUG)
+
+ROI_MARGIN = 0.5 # How much the region searched extends past the last found
+                 # target on each side, as a fraction of its larger side
+MAX_MISSES = 3 # Number of frames the target can be missing from the region
+               # before the whole image is searched again
+EDGE_DISTANCE = 2 # Corners this close to the edge of the region mean the
+                  # target might not be fully inside it
+
+def get_bounds(corners):
+    """Return the bounding box (x1, y1, x2, y2) of a set of corners."""
+    points = np.concatenate(corners).reshape(-1, 2)
+    x1, y1 = points.min(axis=0)
+    x2, y2 = points.max(axis=0)
+    return int(x1), int(y1), int(x2), int(y2)
+
+class TapeTracker(object):
+    """
+    Finds the corners of the tape in a sequence of images, searching
+    only the region around the corners found in the last image.
+
+    The whole image is searched when there are no previous corners,
+    after the target is missing from the region for max_misses frames,
+    or when the target found is touching the edge of the region (which
+    means it may be cut off).
+    """
+
+    def __init__(self, margin=ROI_MARGIN, max_misses=MAX_MISSES):
+        self.margin = margin
+        self.max_misses = max_misses
+        self.corners = None # Corners last found in a full search or region
+        self.misses = 0
+        self.pool = BufferPool()
+
+    def reset(self):
+        """Forget the last found target, so the next image is searched
+        entirely."""
+        self.corners = None
+        self.misses = 0
+
+    def get_roi(self, shape):
+        """Return the region (x1, y1, x2, y2) to search in an image of the
+        given shape, based on the last found corners."""
+        h, w = shape[:2]
+        x1, y1, x2, y2 = get_bounds(self.corners)
+        pad = int(max(x2 - x1, y2 - y1) * self.margin)
+        return (max(x1 - pad, 0), max(y1 - pad, 0),
+                min(x2 + pad + 1, w), min(y2 + pad + 1, h))
+
+    def _on_edge(self, corners, roi, shape):
+        """Return True if any of the corners are on an edge of the region
+        that isn't also an edge of the image."""
+        h, w = shape[:2]
+        rx1, ry1, rx2, ry2 = roi
+        x1, y1, x2, y2 = get_bounds(corners)
+        return ((rx1 > 0 and x1 - rx1 < EDGE_DISTANCE) or
+                (ry1 > 0 and y1 - ry1 < EDGE_DISTANCE) or
+                (rx2 < w and rx2 - 1 - x2 < EDGE_DISTANCE) or
+                (ry2 < h and ry2 - 1 - y2 < EDGE_DISTANCE))
+
+    def _search(self, img, roi, debug_img):
+        """Return the corners found in a region of the image."""
+        x1, y1, x2, y2 = roi
+        mask = get_mask(img[y1:y2, x1:x2], self.pool)
+        _, crns = get_tape_contours_and_corners(mask, debug_img, (x1, y1))
+        return mask, crns
+
+    def get_corners(self, img, n='', show_image=DEBUG):
+        """Return an array of the corners of the tape in a given image,
+        like tapecontours.get_corners_from_image."""
+        with PROFILER.stage('track'):
+            debug_img = copy_image(img, self.pool) if show_image else None
+            h, w = img.shape[:2]
+            full = (0, 0, w, h)
+
+            crns = None
+            if self.corners is not None and self.misses < self.max_misses:
+                roi = self.get_roi(img.shape)
+                mask, crns = self._search(img, roi, debug_img)
+                if len(crns) < 2:
+                    self.misses += 1
+                elif self._on_edge(crns, roi, img.shape):
+                    crns = None
+                else:
+                    self.misses = 0
+                    self.corners = crns
+
+            if crns is None or (self.misses >= self.max_misses):
+                if show_image:
+                    debug_img = copy_image(img, self.pool)
+                mask, crns = self._search(img, full, debug_img)
+                self.misses = 0
+                self.corners = crns if len(crns) >= 2 else None
+
+            if show_image:
+                cv2.imshow('mask{}'.format(n), mask)
+                cv2.imshow('corners{}'.format(n), debug_img)
+
+        return crns
@@ -10,9 +10,17 @@ Most of the documentation you'll see here comes from
 http://docs.opencv.org/3.0-beta/modules/videoio/doc/reading_and_writing_video.html.
 """
 
+from collections import namedtuple
 import threading
+import time
 import cv2
 
+RETRY_DELAY = 0.01 # Seconds to wait after failing to read a frame before trying again
+
+# A frame read by the capture thread. seq increases by one for every frame read, and timestamp
+# is the time.monotonic() time the frame was grabbed at.
+Frame = namedtuple('Frame', ['seq', 'timestamp', 'status', 'image'])
+
 class VideoCapture(threading.Thread):
     """
     A drop-in replacement for cv2's VideoCapture that runs the capture on a separate thread,
@@ -23,13 +31,24 @@ class VideoCapture(threading.Thread):
         threading.Thread.__init__(self)
         self._stop = threading.Event()
         self._vc = cv2.VideoCapture(*args)
-        self._image = None
-        self._status = False
+        self._frame = Frame(-1, None, False, None)
+        self._new_frame = threading.Condition()
 
     def run(self):
-        """Continuously read images in a loop."""
+        """Continuously read images in a loop, notifying anything waiting for a new frame."""
+        seq = 0
         while not self._stop.isSet():
-            self._status, self._image = self._read()
+            grabbed = self._grab()
+            timestamp = time.monotonic()
+            status, image = self._retrieve() if grabbed else (False, None)
+
+            with self._new_frame:
+                self._frame = Frame(seq, timestamp, status, image)
+                self._new_frame.notify_all()
+            seq += 1
+
+            if not status:
+                self._stop.wait(RETRY_DELAY)
 
     def open(self, fileOrDevice):
         """Open a video file or a capturing device for video capturing.
@@ -60,7 +79,7 @@ class VideoCapture(threading.Thread):
         then call VideoCapture::retrieve() one or more times with different values of the channel
         parameter. See https://github.com/Itseez/opencv/tree/master/samples/cpp/openni_capture.cpp.
         """
-        self._vc.grab()
+        return self._vc.grab()
 
     def _retrieve(self, *args):
         """Decode and return the grabbed video frame.
@@ -82,7 +101,22 @@ class VideoCapture(threading.Thread):
 
     def read(self):
         """Return the last status and image obtained from calling cv2's read."""
-        return self._status, self._image
+        frame = self._frame
+        return frame.status, frame.image
+
+    def read_frame(self, timeout=None, newer_than=None):
+        """Return the latest Frame once there is one with a sequence number greater than
+        newer_than, waiting for up to timeout seconds (or forever if it is None).
+
+        If newer_than is None, any frame will do. None is returned if the timeout runs out. Passing
+        the sequence number of the last frame processed means the same frame is never returned
+        twice, without polling for a new one.
+        """
+        newer_than = -1 if newer_than is None else newer_than
+        with self._new_frame:
+            if not self._new_frame.wait_for(lambda: self._frame.seq > newer_than, timeout):
+                return None
+            return self._frame
 
     def get(self, propId):
         """Return the specified VideoCapture property.
@@ -6,22 +6,26 @@ import cv2
 import numpy as np
 
 from processing.stereo import process
+from processing.stereocapture import StereoCapture
+from processing.videocapture import VideoCapture
 # Gst = gs.Gst
 
 if __name__ == '__main__':
-    cleft = cv2.VideoCapture(0)
-    cright = cv2.VideoCapture(1)
+    stereo = StereoCapture(VideoCapture(0), VideoCapture(1))
+    stereo.start()
 
 
     while True:
-        _, ileft = cleft.read()
-        _, iright = cright.read()
+        pair = stereo.read_pair()
 
-        ipleft = np.rot90(ileft, 3)
-        ipright = np.rot90(iright, 3)
+        ipleft = np.rot90(pair.left.image, 3)
+        ipright = np.rot90(pair.right.image, 3)
 
-        points = process(ipleft, ipright, True)
+        process(ipleft, ipright, True)
 
 
         if cv2.waitKey(1) == ord('q'):
+            stereo.stop()
+            print('Paired {} frames, dropped {}'.format(stereo.pairs,
+                                                        stereo.dropped))
             break
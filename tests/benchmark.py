@@ -0,0 +1,180 @@
+"""
+Benchmarks for the image processing hot path.
+
+This runs the images in testImages/original through the detection code
+at several resolutions, then prints the frame rate and latency
+distribution of each function as JSON, along with the peak memory used
+and the number of control messages of each type parsed a second.
+Run it from the root of the repository:
+
+    python3 -m tests.benchmark --output results.json
+
+To catch changes that slow down processing, save a baseline on the
+Raspberry Pi and then compare against it. The command exits with a
+status of 1 if any benchmark's frame rate drops by more than the
+tolerance.
+
+    python3 -m tests.benchmark --save-baseline
+    python3 -m tests.benchmark --baseline tests/benchmark_baseline.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+import cv2
+
+from src.networking import messages
+from src.processing import scoring, stereo, tapecontours
+from src.processing.profiling import Profiler
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGE_DIR = os.path.join(CURRENT_DIR, 'testImages/original')
+BASELINE_FILE = os.path.join(CURRENT_DIR, 'benchmark_baseline.json')
+
+RESOLUTIONS = ((320, 240), (640, 480), (960, 720), (1280, 960))
+REPEAT = 5 # Number of times each image is processed per benchmark
+TOLERANCE = 0.15 # Maximum fraction the frame rate can drop by
+STEREO_SHIFT = 20 # Pixels the right image is shifted by to create disparity
+PARSES = 10000 # Number of times each type of message is parsed
+
+def detect_tape(img):
+    """Find the corners of the tape in an image, as main.py does."""
+    return tapecontours.get_corners_from_image(img, show_image=False)
+
+def score_contours(img):
+    """Find the best target in an image, as main_experiment.py does."""
+    mask, _, bestcnt = scoring.get_best_contour(img)
+    if bestcnt is not None:
+        scoring.get_corners(mask, bestcnt)
+
+def process_stereo(img):
+    """Process a stereo pair made from an image and a shifted copy."""
+    return stereo.process(img, np.roll(img, -STEREO_SHIFT, axis=1))
+
+BENCHMARKS = {
+    'tapecontours': detect_tape,
+    'experiment': score_contours,
+    'stereo': process_stereo
+}
+
+def load_images(directory=IMAGE_DIR):
+    """Return a list of the images in the given directory."""
+    return [cv2.imread(os.path.join(directory, f))
+            for f in sorted(os.listdir(directory))]
+
+def peak_rss():
+    """Return the peak resident memory of this process, in kilobytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss // 1024 # Reported in bytes on macOS
+    return rss
+
+def run_benchmark(function, images, repeat=REPEAT):
+    """Return statistics of calling the function on each image."""
+    profiler = Profiler(size=len(images) * repeat, enabled=True)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for img in images:
+            with profiler.stage('call'):
+                function(img)
+    elapsed = time.perf_counter() - start
+
+    result = profiler.stats()['call']
+    result['fps'] = result['count'] / elapsed
+    return result
+
+def parse_messages(parses=PARSES):
+    """Return the number of messages of each type parsed a second."""
+    samples = {int: 1, str: 'a', list: [[(1, 2), (3, 4)]]}
+    rates = {}
+    for message_type, schema in sorted(messages.MESSAGES.items()):
+        fields = {f: samples[t] for f, t in schema.items()}
+        message = messages.create_message(message_type, fields)
+        start = time.perf_counter()
+        for _ in range(parses):
+            messages.parse_message(message)
+        rates[message_type] = parses / (time.perf_counter() - start)
+    return rates
+
+def run_all(images, resolutions=RESOLUTIONS, benchmarks=BENCHMARKS,
+            repeat=REPEAT):
+    """Run every benchmark at every resolution and return the results."""
+    results = {
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'resolutions': {}
+    }
+    for w, h in resolutions:
+        resized = [cv2.resize(img, (w, h)) for img in images]
+        res = {}
+        for name, function in sorted(benchmarks.items()):
+            res[name] = run_benchmark(function, resized, repeat)
+        res['peak_rss_kb'] = peak_rss()
+        results['resolutions']['{}x{}'.format(w, h)] = res
+    results['messages_per_second'] = parse_messages()
+    return results
+
+def find_regressions(results, baseline, tolerance=TOLERANCE):
+    """Return a list of descriptions of the benchmarks whose frame rate
+    dropped by more than the tolerance compared to the baseline.
+    """
+    regressions = []
+    for res, benchmarks in baseline['resolutions'].items():
+        for name, base in benchmarks.items():
+            if not isinstance(base, dict):
+                continue
+            try:
+                fps = results['resolutions'][res][name]['fps']
+            except KeyError:
+                continue
+            if fps < base['fps'] * (1 - tolerance):
+                regressions.append('{} at {}: {:.1f} fps (baseline {:.1f})'
+                                   .format(name, res, fps, base['fps']))
+    return regressions
+
+def main(argv=None):
+    """Run the benchmarks from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', help='file to write the results to')
+    parser.add_argument('--baseline', help='baseline results to compare to')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    args = parser.parse_args(argv)
+
+    # Keep anything printed while processing out of the JSON output
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run_all(load_images(), repeat=args.repeat)
+    output = json.dumps(results, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.save_baseline:
+        with open(BASELINE_FILE, 'w') as f:
+            f.write(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for r in regressions:
+            print('Regression: {}'.format(r), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,6 +2,7 @@
 This file contains tests for gstreamer.py.
 """
 
+import time
 import unittest
 
 from src import gstreamer as gs
@@ -24,6 +25,33 @@ class GstPipelineTests(unittest.TestCase):
         e = 'fakesrc ! tee name=t ! queue ! fakesink t. ! queue ! fakesink'
         self.assertEqual(p, e)
 
+class GstAppSinkTests(unittest.TestCase):
+    """
+    Tests for reading frames from a pipeline with gs.AppSinkCapture
+    """
+
+    def test_pull(self):
+        """Test that frames pulled from an appsink are mapped as BGR images
+        of the right size with timestamps."""
+        p = gs.pipeline(gs.TestSrc(width=322, height=240) + gs.AppSink())
+        p.set_state(gs.Gst.State.PLAYING)
+        p.get_state(gs.Gst.CLOCK_TIME_NONE)
+
+        cap = gs.AppSinkCapture(p)
+        try:
+            with cap.pull() as frame:
+                self.assertEqual(frame.image.shape, (240, 322, 3))
+                self.assertFalse(frame.image.flags.writeable)
+                self.assertNotEqual(frame.pts, gs.Gst.CLOCK_TIME_NONE)
+                self.assertLessEqual(frame.timestamp, time.monotonic())
+            self.assertIsNone(frame.image)
+
+            status, img = cap.read()
+            self.assertTrue(status)
+            self.assertEqual(img.shape, (240, 322, 3))
+        finally:
+            p.set_state(gs.Gst.State.NULL)
+
 class GstUtilitiesTest(unittest.TestCase):
     """
     Tests for testing utilities contained within gstreamer.py
@@ -45,5 +45,81 @@ class MessagesTest(unittest.TestCase):
         m = '{"type": "error", "message": 123456}'
         self.assertRaises(ValueError, messages.parse_message, m)
 
+    def test_parse_not_object(self):
+        """Test that JSON that isn't an object throws errors."""
+        for m in ('[]', '"type"', '{"type": ["error"]}'):
+            self.assertRaises(ValueError, messages.parse_message, m)
+
+    def test_optional_fields(self):
+        """Test that optional fields are given defaults when left out and
+        are still checked when included."""
+        parsed = messages.parse_message(messages.create_message(
+            messages.TYPE_SUBSCRIBE, {
+                messages.FIELD_LEVEL: messages.LEVEL_FULL,
+                messages.FIELD_RATE: 2.5
+            }))
+        self.assertEqual(parsed[messages.FIELD_RATE], 2.5)
+        self.assertEqual(parsed[messages.FIELD_DECIMATION], 1)
+
+        m = '{"type": "subscribe", "level": "full", "decimation": "2"}'
+        self.assertRaises(ValueError, messages.parse_message, m)
+
+class BinaryMessagesTest(unittest.TestCase):
+    """
+    Tests for creating and parsing binary results messages
+    """
+
+    def test_results(self):
+        """Test that results are the same after being packed and
+        unpacked, and are smaller than JSON."""
+        fields = {
+            messages.FIELD_CORNERS: [[(1, 2), (3, 4), (5, 6), (7, 8)],
+                                     [(-1, -2), (300, 400), (5, 6), (7, 8)]],
+            messages.FIELD_VALID: [[[[1, 2]], [[3, 4]], [[5, 6]]]],
+            messages.FIELD_SEQ: 12,
+            messages.FIELD_TIMESTAMP: 1234.5,
+        }
+        binary = messages.create_binary_message(messages.TYPE_RESULTS, fields)
+        parsed = messages.parse_binary_message(binary)
+        self.assertEqual(parsed[messages.FIELD_TYPE], messages.TYPE_RESULTS)
+        self.assertEqual(parsed[messages.FIELD_CORNERS],
+                         [[list(p) for p in c]
+                          for c in fields[messages.FIELD_CORNERS]])
+        self.assertEqual(parsed[messages.FIELD_VALID],
+                         [[[1, 2], [3, 4], [5, 6]]])
+        self.assertEqual(parsed[messages.FIELD_SEQ], 12)
+        self.assertEqual(parsed[messages.FIELD_TIMESTAMP], 1234.5)
+        self.assertNotIn(messages.FIELD_LATENCY, parsed)
+
+        json_message = messages.create_message(messages.TYPE_RESULTS, fields)
+        self.assertLess(len(binary), len(json_message) / 2)
+
+    def test_flat_corners(self):
+        """Test that corners that aren't arrays of points (e.g. a bounding
+        box) throw errors instead of being packed differently from
+        JSON."""
+        self.assertRaises(ValueError, messages.create_binary_message,
+                          messages.TYPE_RESULTS,
+                          {messages.FIELD_CORNERS: (1, 2, 30, 40)})
+
+    def test_simple_results(self):
+        """Test that simple results can be packed and unpacked."""
+        binary = messages.create_message_as(
+            messages.FORMAT_BINARY, messages.TYPE_SIMPLERESULTS,
+            {messages.FIELD_XDISP: -42})
+        parsed = messages.parse_binary_message(binary)
+        self.assertEqual(parsed[messages.FIELD_XDISP], -42)
+
+    def test_bad_message(self):
+        """Test that truncated or JSON messages throw errors."""
+        binary = messages.create_binary_message(
+            messages.TYPE_SIMPLERESULTS, {messages.FIELD_XDISP: 1})
+        self.assertRaises(ValueError, messages.parse_binary_message,
+                          binary[:-1])
+        self.assertRaises(ValueError, messages.parse_binary_message,
+                          b'{"type": "stop"}\n')
+        self.assertRaises(ValueError, messages.create_binary_message,
+                          messages.TYPE_ERROR, {})
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
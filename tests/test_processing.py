@@ -6,14 +6,22 @@ the pieces of tape and making sure these coordinates are close to those
 returned by the image processing algorithms.
 """
 
+from functools import partial
 import os
 import sys
+import tempfile
+import time
 import unittest
 
 import numpy as np
 import cv2
 
-from src.processing import tapecontours
+from src.processing import (profiling, rectification, scoring, stereo,
+                            tapecontours, tracking)
+from src.processing.buffers import BufferPool
+from src.processing.parallel import ParallelProcessor
+from src.processing.stereocapture import StereoCapture
+from src.processing.videocapture import Frame, VideoCapture
 
 # Range for fist mask
 LOW_RED = np.array([169, 100, 100])
@@ -105,5 +113,399 @@ class ImageTests(unittest.TestCase):
               .format(correct, incorrect, percent*100))
         self.assertGreater(percent, self.LEAST_PERCENT)
 
+class BufferPoolTests(unittest.TestCase):
+    """
+    Tests for reusing buffers between frames with processing.buffers
+    """
+
+    def test_reuse(self):
+        """Test that buffers are reused as long as they are big enough."""
+        pool = BufferPool()
+        a = pool.get('a', (480, 640))
+        b = pool.get('a', (240, 320))
+        self.assertTrue(np.shares_memory(a, b))
+        self.assertEqual(b.shape, (240, 320))
+        c = pool.get('a', (960, 1280))
+        self.assertFalse(np.shares_memory(a, c))
+        self.assertEqual(pool.nbytes(), 960 * 1280)
+
+    def test_same_corners(self):
+        """Test that processing with a pool gives the same corners."""
+        currentdir = os.path.dirname(os.path.abspath(__file__))
+        origdir = os.path.join(currentdir, 'testImages/original')
+        pool = BufferPool()
+        for f in os.listdir(origdir):
+            img = cv2.imread(os.path.join(origdir, f))
+            expected = tapecontours.get_corners_from_image(img,
+                                                           show_image=False)
+            actual = tapecontours.get_corners_from_image(img,
+                                                         show_image=False,
+                                                         pool=pool)
+            self.assertEqual(expected, actual)
+
+class ParallelProcessorTests(unittest.TestCase):
+    """
+    Tests for processing frames in worker processes with
+    processing.parallel
+    """
+
+    def test_in_order(self):
+        """Test that the results of processing the test images in
+        parallel are the same and in the same order as doing it serially."""
+        currentdir = os.path.dirname(os.path.abspath(__file__))
+        origdir = os.path.join(currentdir, 'testImages/original')
+        images = [cv2.resize(cv2.imread(os.path.join(origdir, f)), (640, 480))
+                  for f in sorted(os.listdir(origdir))]
+        function = partial(tapecontours.get_corners_from_image,
+                           show_image=False, pool=BufferPool())
+        expected = [function(img) for img in images]
+
+        processor = ParallelProcessor(function, images[0].shape, workers=3)
+        actual = []
+        try:
+            for i, img in enumerate(images):
+                self.assertEqual(processor.submit(img), i)
+                actual.extend(processor.ready())
+            while processor.pending() > 0:
+                actual.append(processor.get())
+        finally:
+            processor.close()
+
+        self.assertEqual([seq for seq, _ in actual], list(range(len(images))))
+        self.assertEqual([result for _, result in actual], expected)
+
+class CameraSpeedCapture(VideoCapture):
+    """A VideoCapture that reads a file at about the speed of a camera."""
+
+    def _grab(self):
+        time.sleep(1 / 100)
+        return super()._grab()
+
+class VideoCaptureTests(unittest.TestCase):
+    """
+    Tests for reading frames on a separate thread with
+    processing.videocapture
+    """
+
+    def test_new_frames(self):
+        """Test that waiting for frames newer than the last one read never
+        returns the same frame twice."""
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'video.avi')
+            writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'MJPG'),
+                                     30, (64, 48))
+            for i in range(10):
+                writer.write(np.full((48, 64, 3), i * 20, np.uint8))
+            writer.release()
+
+            vc = CameraSpeedCapture(filename)
+            vc.daemon = True
+            vc.start()
+            try:
+                seqs = []
+                frame = vc.read_frame(timeout=5)
+                while frame is not None and frame.status:
+                    seqs.append(frame.seq)
+                    frame = vc.read_frame(timeout=5, newer_than=frame.seq)
+            finally:
+                vc.stop()
+
+        self.assertIsNotNone(frame, 'Timed out waiting for a frame')
+        self.assertTrue(0 < len(seqs) <= 10)
+        self.assertEqual(seqs, sorted(set(seqs)))
+        self.assertIsNone(vc.read_frame(timeout=0, newer_than=frame.seq + 100))
+
+class ScriptedCapture(object):
+    """A capture that returns frames with the given timestamps, in
+    order, as if each was the newest frame when it was read."""
+
+    def __init__(self, timestamps):
+        self.frames = [Frame(i, t, True, t) for i, t in enumerate(timestamps)]
+
+    def read_frame(self, timeout=None, newer_than=None):
+        """Return the next frame, or None if there are no more."""
+        newer_than = -1 if newer_than is None else newer_than
+        return next((f for f in self.frames if f.seq > newer_than), None)
+
+class StereoCaptureTests(unittest.TestCase):
+    """
+    Tests for pairing the frames of two cameras with
+    processing.stereocapture
+    """
+
+    def test_pairing(self):
+        """Test that frames are paired with the frame nearest in time from
+        the other camera, and that frames without one are dropped."""
+        left = ScriptedCapture([0.000, 0.033, 0.066, 0.100, 0.133])
+        right = ScriptedCapture([0.005, 0.050, 0.070, 0.098, 0.160])
+        stereo = StereoCapture(left, right, tolerance=0.01)
+
+        pairs = []
+        pair = stereo.read_pair(timeout=0)
+        while pair is not None:
+            pairs.append((pair.left.image, pair.right.image))
+            pair = stereo.read_pair(timeout=0)
+
+        self.assertEqual(pairs, [(0.000, 0.005), (0.066, 0.070),
+                                 (0.100, 0.098)])
+        self.assertEqual(stereo.pairs, 3)
+        # 0.033, 0.050 and 0.133 can never be paired, and 0.160 might be
+        self.assertEqual(stereo.dropped, 3)
+
+class StereoTests(unittest.TestCase):
+    """
+    Tests for finding the tape in pairs of images with processing.stereo
+    """
+
+    def test_parallel(self):
+        """Test that searching both images at once finds the same corners
+        as searching them one after the other."""
+        currentdir = os.path.dirname(os.path.abspath(__file__))
+        stereodir = os.path.join(currentdir, 'testImages/stereo')
+        for f in sorted(os.listdir(os.path.join(stereodir, 'left_images')))[:10]:
+            left = cv2.imread(os.path.join(stereodir, 'left_images', f))
+            right = cv2.imread(os.path.join(stereodir, 'right_images', f))
+            expected = stereo.get_corners_from_pair(left, right, parallel=False)
+            actual = stereo.get_corners_from_pair(left, right)
+            self.assertEqual(expected, actual)
+
+    def test_disparity(self):
+        """Test that depths are found from the disparity of each corner and
+        that corners with outlying depths are ignored."""
+        right = np.array([[100, 50], [120, 50], [100, 90], [120, 90]] * 2,
+                         np.float64)
+        disparity = np.array([20, 22] * 3 + [20, 60], np.float64)
+        left = right + np.column_stack([disparity, np.zeros(8)])
+        result = stereo.triangulate(left, right)
+        depths = stereo.BASELINE * stereo.FOCAL_LENGTH / disparity
+        self.assertTrue(np.allclose(result.depths, depths))
+        self.assertEqual(result.valid.tolist(), [True] * 7 + [False])
+        # The distance comes from the mean disparity, not the mean depth
+        depth = stereo.BASELINE * stereo.FOCAL_LENGTH / np.mean(disparity[:7])
+        self.assertAlmostEqual(result.distance, stereo.DISTANCE_SCALE * depth +
+                               stereo.DISTANCE_OFFSET)
+        self.assertAlmostEqual(result.offset, stereo.CENTER_X -
+                               np.mean(left[:7, 0] + right[:7, 0]) / 2)
+        self.assertAlmostEqual(result.residual, 0)
+
+    def test_triangulate(self):
+        """Test that corners triangulated with the cameras' projection
+        matrices are at the depths they were projected from."""
+        matrix = np.array([[585, 0, 240], [0, 585, 320], [0, 0, 1]], np.float64)
+        P1 = matrix.dot(np.hstack([np.eye(3), np.zeros((3, 1))]))
+        P2 = matrix.dot(np.hstack([np.eye(3), [[-7.25], [0], [0]]]))
+        points = np.array([[x, y, z, 1] for x, y in ((-5, -2), (5, -2), (-5, 2),
+                                                     (5, 2))
+                           for z in (100, 101)], np.float64).T
+        left = P1.dot(points)
+        right = P2.dot(points)
+        result = stereo.triangulate((left[:2] / left[2]).T,
+                                    (right[:2] / right[2]).T, P1, P2)
+        self.assertTrue(np.allclose(result.depths, points[2]))
+        self.assertTrue(np.all(result.valid))
+        self.assertAlmostEqual(result.distance, 100.5)
+        self.assertLess(result.residual, 1e-6)
+
+class RectificationTests(unittest.TestCase):
+    """
+    Tests for rectifying stereo images with processing.rectification
+    """
+
+    def test_cache(self):
+        """Test that the remap tables are cached under a hash of the
+        calibration, and that rectifying a region matches rectifying the
+        whole image."""
+        calib = rectification.load_calibration()
+        with tempfile.TemporaryDirectory() as tmp:
+            rectifier = rectification.Rectifier(calib, map_dir=tmp)
+            maps = rectifier.maps()
+            self.assertTrue(os.path.exists(rectifier.map_filename()))
+
+            cached = rectification.Rectifier(calib, map_dir=tmp)
+            self.assertEqual(cached.map_filename(), rectifier.map_filename())
+            for (a1, a2), (b1, b2) in zip(maps, cached.maps()):
+                self.assertTrue(np.array_equal(a1, b1))
+                self.assertTrue(np.array_equal(a2, b2))
+
+            moved = dict(calib, trans_matrix=calib['trans_matrix'] * 2)
+            self.assertNotEqual(rectification.calibration_hash(moved),
+                                rectifier.key)
+
+        img = np.random.randint(0, 256, (480, 640, 3), np.uint8)
+        whole = cv2.remap(img, maps[1][0], maps[1][1], cv2.INTER_LINEAR)
+        region = rectifier.rectify(img, 1, (100, 50, 120, 80))
+        self.assertTrue(np.array_equal(region, whole[50:130, 100:220]))
+        self.assertRaises(ValueError, rectifier.rectify, img[:100], 0)
+
+    def test_points(self):
+        """Test that undistorting points gives back where they were before
+        they were distorted, and that rectifying points matches
+        rectifying images."""
+        # The saved calibration has an identity camera matrix, so a made
+        # up one with the Pi camera's focal length is used instead
+        matrix = np.array([[592.2, 0, 309.2], [0, 587.0, 249.4], [0, 0, 1]])
+        dist = np.array([[0.1, -0.2, 0.001, 0.002, 0.05]])
+        expected = np.array([[100, 80], [320, 240], [500, 400]], np.float64)
+        # Project the undistorted points back through the camera's lens
+        normalized = np.c_[(expected - matrix[:2, 2]) / np.diag(matrix)[:2],
+                           np.ones(len(expected))]
+        distorted, _ = cv2.projectPoints(normalized, np.zeros(3), np.zeros(3),
+                                         matrix, dist)
+        self.assertGreater(np.max(np.abs(distorted.reshape(-1, 2) - expected)),
+                           1)
+        actual = rectification.undistort_points(distorted, matrix, dist)
+        self.assertLess(np.max(np.abs(actual - expected)), 0.5)
+
+        side = {'camera_matirx': matrix, 'dist_coeffs': dist}
+        rotation, _ = cv2.Rodrigues(np.array([0.01, -0.02, 0.005]))
+        rectifier = rectification.Rectifier({
+            'left': side, 'right': side, 'rot_matrix': rotation,
+            'trans_matrix': np.array([[-5.0], [0.1], [0.0]]),
+            'img_size': (640, 480)
+        })
+        map1, map2 = rectifier.build_maps()[0]
+        # The remap tables give the raw pixel each rectified pixel comes from
+        raw = cv2.convertMaps(map1, map2, cv2.CV_32FC2)[0]
+        for x, y in ((320, 240), (100, 400)):
+            rectified = rectifier.rectify_points([raw[y, x]], 0)
+            self.assertLess(np.max(np.abs(rectified - [x, y])), 0.5)
+
+class ScoringTests(unittest.TestCase):
+    """
+    Tests for finding targets with processing.scoring
+    """
+
+    def test_get_target(self):
+        """Test that the bounding box of a green square is found, and that
+        nothing is found in a black image."""
+        img = np.zeros((240, 320, 3), np.uint8)
+        self.assertEqual(scoring.get_target(img), (None, []))
+
+        img[100:160, 50:110] = (0, 255, 0)
+        bbox, valid = scoring.get_target(img)
+        self.assertEqual(len(valid), 1)
+        for found, expected in zip(bbox, (50, 100, 60, 60)):
+            self.assertAlmostEqual(found, expected, delta=3)
+
+    def test_bbox_points(self):
+        """Test that the corners of a bounding box are found."""
+        self.assertEqual(scoring.bbox_points((np.int32(10), 20, 30, 40)),
+                         [(10, 20), (40, 20), (40, 60), (10, 60)])
+
+class ContourFeaturesTests(unittest.TestCase):
+    """
+    Tests for the table of contour properties used by tapecontours
+    """
+
+    def test_matches_opencv(self):
+        """Test that the computed properties are the same as OpenCV's."""
+        currentdir = os.path.dirname(os.path.abspath(__file__))
+        img = cv2.imread(os.path.join(currentdir, 'testImages/original',
+                                      '1ftH3ftD2Angle0Brightness.jpg'))
+        _, cnt, _ = cv2.findContours(tapecontours.get_mask(img),
+                                     cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        features = tapecontours.ContourFeatures(cnt)
+
+        self.assertGreater(len(features), 0)
+        for i, c in enumerate(cnt):
+            self.assertEqual(features.area[i], cv2.contourArea(c))
+            self.assertEqual(tuple(features.rect[i]), cv2.boundingRect(c))
+            self.assertEqual(tuple(features.center[i]),
+                             tapecontours.get_center(c))
+            self.assertEqual(features.perimeter[i], cv2.arcLength(c, True))
+
+class TrackerTests(unittest.TestCase):
+    """
+    Tests for tracking the tape between frames with processing.tracking
+    """
+
+    def setUp(self):
+        currentdir = os.path.dirname(os.path.abspath(__file__))
+        self.img = cv2.imread(os.path.join(currentdir, 'testImages/original',
+                                           '1ftH5ftD0Angle0Brightness.jpg'))
+
+    def test_region(self):
+        """Test that searching the region around the last target finds
+        the same corners as searching the whole image."""
+        tracker = tracking.TapeTracker()
+        expected = tapecontours.get_corners_from_image(self.img,
+                                                       show_image=False)
+        first = tracker.get_corners(self.img, show_image=False)
+        x1, y1, x2, y2 = tracker.get_roi(self.img.shape)
+        second = tracker.get_corners(self.img, show_image=False)
+
+        self.assertEqual(len(expected), 2)
+        self.assertEqual(first, expected)
+        self.assertEqual(second, expected)
+        self.assertLess((x2-x1) * (y2-y1), self.img.size / 3 / 2)
+
+    def test_misses(self):
+        """Test that the whole image is searched again after the target
+        has been missing from the region."""
+        tracker = tracking.TapeTracker(max_misses=2)
+        tracker.get_corners(self.img, show_image=False)
+        blank = np.zeros_like(self.img)
+        self.assertEqual(tracker.get_corners(blank, show_image=False), [])
+        self.assertEqual(tracker.misses, 1)
+        self.assertEqual(tracker.get_corners(blank, show_image=False), [])
+        self.assertIsNone(tracker.corners)
+
+class ProfilerTests(unittest.TestCase):
+    """
+    Tests for the stage timings recorded by processing.profiling
+    """
+
+    def test_disabled(self):
+        """Test that nothing is recorded while the profiler is off."""
+        p = profiling.Profiler()
+        with p.stage('stage'):
+            pass
+        self.assertDictEqual(p.stats(), {})
+
+    def test_ring_buffer(self):
+        """Test that only the most recent timings are kept."""
+        p = profiling.Profiler(size=4, enabled=True)
+        for t in (10, 10, 10, 10, 1, 2, 3, 4):
+            p.record('stage', t / 1000)
+        stats = p.stats()['stage']
+        self.assertEqual(stats['count'], 8)
+        self.assertAlmostEqual(stats['max'], 4)
+        self.assertAlmostEqual(stats['p50'], 2.5)
+
+    def test_stages(self):
+        """Test that processing an image records each stage."""
+        currentdir = os.path.dirname(os.path.abspath(__file__))
+        img = cv2.imread(os.path.join(currentdir, 'testImages/original',
+                                      'img-center.png'))
+        profiling.PROFILER.enabled = True
+        try:
+            tapecontours.get_corners_from_image(img, show_image=False)
+        finally:
+            profiling.PROFILER.enabled = False
+        stats = profiling.PROFILER.stats()
+        profiling.PROFILER.reset()
+        for stage in ('mask', 'find_contours', 'total'):
+            self.assertIn(stage, stats)
+
+    def test_latency(self):
+        """Test that the latency of each step adds up to the total."""
+        p = profiling.Profiler(enabled=True)
+        latency = profiling.LatencyTracker(p)
+        latency.start(0, time.monotonic() - 0.06)
+        latency.mark(0, 'capture', time.monotonic() - 0.01)
+        latency.mark(0, 'processing')
+        self.assertGreaterEqual(latency.age(0), 0.06)
+        latency.finish(0)
+        latency.start(1, time.monotonic())
+        latency.finish(1, record=False)
+
+        stats = p.stats()
+        self.assertGreaterEqual(stats['capture']['max'], 50)
+        self.assertGreaterEqual(stats['processing']['max'], 10)
+        self.assertEqual(stats['total']['count'], 1)
+        self.assertAlmostEqual(stats['total']['max'],
+                               stats['capture']['max'] +
+                               stats['processing']['max'], delta=1)
+
 if __name__ == '__main__':
     unittest.main()
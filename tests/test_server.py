@@ -0,0 +1,451 @@
+"""
+This file contains tests for networking/server.py.
+"""
+
+import json
+import socket
+import time
+from types import SimpleNamespace
+import unittest
+from urllib.request import urlopen
+
+import numpy as np
+
+from src.networking import (aioserver, create_gst_handler, metrics, policy,
+                            results, server, udp)
+from src.networking import messages as m
+from src.processing.profiling import Profiler
+
+def recv_until(sock, size, timeout=2):
+    """Receive data from a socket until size bytes or nothing more is
+    received."""
+    sock.settimeout(timeout)
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+class FrameBufferTests(unittest.TestCase):
+    """
+    Tests for splitting received data into messages with
+    server.FrameBuffer
+    """
+
+    def test_split(self):
+        """Test that messages split across reads are joined and reads
+        with several messages are split."""
+        frames = server.FrameBuffer()
+        self.assertEqual(frames.feed(b'{"type": "st'), [])
+        self.assertEqual(frames.feed(b'op"}\n{"type": "stop"}\n{'),
+                         [b'{"type": "stop"}', b'{"type": "stop"}'])
+        self.assertEqual(frames.feed(b'}\n'), [b'{}'])
+
+    def test_max_size(self):
+        """Test that messages that are too long are dropped without
+        affecting the ones after them."""
+        frames = server.FrameBuffer(max_size=8)
+        self.assertEqual(frames.feed(b'0123456789\nabc\n'), [b'abc'])
+        self.assertEqual(frames.feed(b'01234'), [])
+        self.assertEqual(frames.feed(b'56789'), [])
+        self.assertEqual(frames.feed(b'0123456789\nabc'), [])
+        self.assertEqual(frames.feed(b'\n'), [b'abc'])
+
+class BroadcastTests(unittest.TestCase):
+    """
+    Tests for sending a message to every client with server.broadcast
+    """
+
+    def test_broadcast(self):
+        """Test that strings and buffers are sent to every client but the
+        server, and the bytes sent to each are reported."""
+        a, a_theirs = socket.socketpair()
+        b, b_theirs = socket.socketpair()
+        with a, a_theirs, b, b_theirs:
+            b_theirs.close()
+            b.shutdown(socket.SHUT_WR)
+            sent = server.broadcast(None, [None, a, b], 'hi\n')
+            self.assertEqual(sent, {a: 3, b: 0})
+            data = bytearray(b'results\n')
+            self.assertEqual(server.broadcast(None, [a], memoryview(data)),
+                             {a: 8})
+            self.assertEqual(recv_until(a_theirs, 11), b'hi\nresults\n')
+
+class AsyncServerTests(unittest.TestCase):
+    """
+    Tests for the asyncio server in aioserver
+    """
+
+    def setUp(self):
+        def echo(conn, data):
+            """Send received data back to the client."""
+            conn.send(data.upper().encode('utf-8') + b'\n')
+        self.server = aioserver.Server(echo, host='127.0.0.1', port=0,
+                                       stall_timeout=0.2)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.server.join()
+
+    def connect(self, rcvbuf=None):
+        """Return a socket connected to the server once the server has
+        seen the connection, with the given receive buffer size."""
+        n = len(self.server.clients)
+        sock = socket.socket()
+        if rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        sock.connect(('127.0.0.1', self.server.port))
+        start = time.monotonic()
+        while len(self.server.clients) == n and time.monotonic() - start < 2:
+            time.sleep(0.01)
+        return sock
+
+    def test_messages(self):
+        """Test that clients get replies and broadcast messages."""
+        with self.connect() as a, self.connect() as b:
+            a.sendall(b'hi\nthe')
+            a.sendall(b're\n')
+            self.assertEqual(recv_until(a, 9), b'HI\nTHERE\n')
+            self.server.broadcast('results\n')
+            self.assertEqual(recv_until(a, 8), b'results\n')
+            self.assertEqual(recv_until(b, 8), b'results\n')
+            # Bytes are only counted once the writer has been drained
+            expected = [aioserver.ClientStats(8, 0, 0),
+                        aioserver.ClientStats(17, 0, 0)]
+            self.wait_for(lambda: sorted(self.server.stats().values()) ==
+                          expected)
+            self.assertEqual(sorted(self.server.stats().values()), expected)
+
+    def wait_for(self, condition):
+        """Wait up to 2 seconds for a condition to become true."""
+        start = time.monotonic()
+        while not condition() and time.monotonic() - start < 2:
+            time.sleep(0.01)
+
+    def test_subscriptions(self):
+        """Test that clients are sent results at the level and in the format
+        they ask for."""
+        self.server.on_new_message = create_gst_handler(None)
+        with self.connect() as a, self.connect() as b:
+            b.sendall(m.create_message(m.TYPE_FORMAT, {
+                m.FIELD_FORMAT: m.FORMAT_BINARY}).encode('utf-8'))
+            b.sendall(m.create_message(m.TYPE_SUBSCRIBE, {
+                m.FIELD_LEVEL: m.LEVEL_SUMMARY}).encode('utf-8'))
+            self.wait_for(lambda: self.server.subscriptions() == {
+                (m.LEVEL_CORNERS, m.FORMAT_JSON),
+                (m.LEVEL_SUMMARY, m.FORMAT_BINARY)})
+
+            results = {}
+            for level, f in self.server.subscriptions():
+                fields = {m.FIELD_CORNERS: [[(1, 2), (3, 4)]],
+                          m.FIELD_SEQ: m.LEVELS.index(level)}
+                results[level, f] = m.create_message_as(f, m.TYPE_RESULTS,
+                                                        fields)
+            self.server.send_results(results)
+            json_message = results[m.LEVEL_CORNERS, m.FORMAT_JSON]
+            binary = results[m.LEVEL_SUMMARY, m.FORMAT_BINARY]
+            self.assertEqual(recv_until(a, len(json_message)), json_message)
+            self.assertEqual(recv_until(b, len(binary)), binary)
+
+    def test_decimation(self):
+        """Test that clients are only sent every nth result when they ask
+        for it, and are told when a subscription is invalid."""
+        self.server.on_new_message = create_gst_handler(None)
+        with self.connect() as a:
+            a.sendall(m.create_message(m.TYPE_SUBSCRIBE, {
+                m.FIELD_LEVEL: m.LEVEL_CORNERS,
+                m.FIELD_DECIMATION: 0}).encode('utf-8'))
+            a.settimeout(2)
+            self.assertIn(b'Decimation', a.recv(1024))
+            a.sendall(m.create_message(m.TYPE_SUBSCRIBE, {
+                m.FIELD_LEVEL: m.LEVEL_CORNERS,
+                m.FIELD_DECIMATION: 3}).encode('utf-8'))
+            self.wait_for(lambda: self.server.clients[0].decimation == 3)
+
+            for i in range(6):
+                self.server.send_results({
+                    (m.LEVEL_CORNERS, m.FORMAT_JSON): str(i).encode('utf-8')})
+            self.assertEqual(recv_until(a, 2, timeout=0.5), b'25')
+
+    def test_send_latency(self):
+        """Test that the time until results are written to a client is
+        recorded."""
+        self.server.profiler = Profiler(enabled=True)
+        with self.connect() as a:
+            self.server.send_results({(m.LEVEL_CORNERS, m.FORMAT_JSON):
+                                      b'results\n'})
+            self.server.broadcast('other\n')
+            self.assertEqual(recv_until(a, 14), b'results\nother\n')
+            self.wait_for(lambda: 'send' in self.server.profiler.stats())
+            self.assertEqual(self.server.profiler.stats()['send']['count'], 1)
+
+    def test_unhandled(self):
+        """Test that clients are sent an error for messages that aren't
+        handled, and stay connected when handling a message fails."""
+        handle = create_gst_handler(None)
+        def handler(conn, data):
+            """Handle a message, failing on ones that aren't JSON."""
+            if not data.startswith('{'):
+                raise RuntimeError('Not JSON')
+            handle(conn, data)
+        self.server.on_new_message = handler
+        with self.connect() as a:
+            a.sendall(b'oops\n')
+            a.sendall(m.create_message(m.TYPE_RESULTS, {
+                m.FIELD_CORNERS: []}).encode('utf-8'))
+            a.settimeout(2)
+            error = m.parse_message(a.recv(1024).decode('utf-8'))
+            self.assertEqual(error[m.FIELD_TYPE], m.TYPE_ERROR)
+            self.assertIn('results', error[m.FIELD_ERROR])
+            self.assertEqual(len(self.server.clients), 1)
+
+    def test_slow_client(self):
+        """Test that a client that stops reading is disconnected without
+        affecting other clients."""
+        with self.connect(rcvbuf=4096) as slow, self.connect() as fast:
+            message = b'x' * 1000000 # More than the kernel buffers
+            for _ in range(20):
+                self.server.broadcast(message)
+                self.assertEqual(recv_until(fast, len(message)), message)
+            time.sleep(0.5)
+            self.assertEqual(len(self.server.clients), 1)
+
+class UDPPublisherTests(unittest.TestCase):
+    """
+    Tests for sending results over UDP with udp.UDPPublisher
+    """
+
+    def test_subscribe(self):
+        """Test that subscribed addresses are sent results in their format
+        until they unsubscribe."""
+        publisher = udp.UDPPublisher()
+        handler = create_gst_handler(None, publisher=publisher)
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(2)
+        port = receiver.getsockname()[1]
+        with receiver:
+            handler(None, m.create_message(m.TYPE_UDP_SUBSCRIBE, {
+                m.FIELD_HOST: '127.0.0.1', m.FIELD_PORT: port,
+                m.FIELD_FORMAT: m.FORMAT_BINARY}))
+            self.assertEqual(publisher.subscriptions(),
+                             {(m.LEVEL_CORNERS, m.FORMAT_BINARY)})
+
+            fields = {m.FIELD_CORNERS: [[(1, 2), (3, 4)]], m.FIELD_SEQ: 5}
+            results = {(level, f): m.create_message_as(f, m.TYPE_RESULTS,
+                                                       fields)
+                       for level in m.LEVELS for f in m.FORMATS}
+            publisher.publish(results)
+            data = receiver.recv(65536)
+            self.assertEqual(m.parse_binary_message(data)[m.FIELD_SEQ], 5)
+
+            handler(None, m.create_message(m.TYPE_UDP_UNSUBSCRIBE, {
+                m.FIELD_HOST: '127.0.0.1', m.FIELD_PORT: port}))
+            self.assertEqual(publisher.subscriptions(), set())
+        publisher.close()
+
+    def test_host_names(self):
+        """Test that hosts have to be IP addresses, so subscribing never
+        waits for a name to be looked up."""
+        publisher = udp.UDPPublisher()
+        for host in ('localhost', 'roboRIO-1072-FRC.local', '127.0.0'):
+            self.assertRaises(ValueError, publisher.subscribe, host, 5800)
+        publisher.subscribe('239.1.2.3', 5800)
+        self.assertEqual(len(publisher.subscriptions()), 1)
+        publisher.close()
+
+    def test_bad_port(self):
+        """Test that addresses with invalid ports can't be subscribed."""
+        publisher = udp.UDPPublisher()
+        handler = create_gst_handler(None, publisher=publisher)
+        for port in (0, -1, 70000):
+            handler(None, m.create_message(m.TYPE_UDP_SUBSCRIBE, {
+                m.FIELD_HOST: '127.0.0.1', m.FIELD_PORT: port}))
+            self.assertRaises(ValueError, publisher.subscribe, '127.0.0.1',
+                              port)
+        self.assertEqual(publisher.subscriptions(), set())
+        publisher.close()
+
+class RecordingSink(object):
+    """Stands in for a Server or UDPPublisher, recording the results it is
+    given."""
+
+    def __init__(self, subscriptions):
+        self._subscriptions = subscriptions
+        self.sent = []
+
+    def subscriptions(self):
+        """Return the (level, format) pairs wanted."""
+        return set(self._subscriptions)
+
+    def send_results(self, sent):
+        """Record results sent like Server.send_results."""
+        self.sent.append(sent)
+
+    publish = send_results
+
+class ResultsTests(unittest.TestCase):
+    """
+    Tests for building and sending results with results.create_levels and
+    results.send_results
+    """
+
+    def test_levels(self):
+        """Test that each level has the fields it should."""
+        corners = [np.array([[10, 20], [30, 25]]), np.array([[[5, 40]]])]
+        levels = results.create_levels(corners, valid=[[[1, 2]]])
+        self.assertEqual(levels[m.LEVEL_SUMMARY],
+                         {m.FIELD_CORNERS: [[(5, 20), (30, 40)]]})
+        self.assertEqual(levels[m.LEVEL_CORNERS],
+                         {m.FIELD_CORNERS: [[(10, 20), (30, 25)], [(5, 40)]]})
+        self.assertEqual(levels[m.LEVEL_FULL][m.FIELD_VALID], [[[1, 2]]])
+        self.assertNotIn(m.FIELD_VALID, results.create_levels([])[m.LEVEL_FULL])
+
+    def test_lost(self):
+        """Test that results with no corners are built when the target
+        isn't found."""
+        levels = results.create_levels([])
+        for level in m.LEVELS:
+            self.assertEqual(levels[level][m.FIELD_CORNERS], [])
+
+    def test_send(self):
+        """Test that each level and format anyone wants is sent, and only
+        those."""
+        srv = RecordingSink([(m.LEVEL_SUMMARY, m.FORMAT_JSON)])
+        pub = RecordingSink([(m.LEVEL_CORNERS, m.FORMAT_BINARY),
+                             (m.LEVEL_SUMMARY, m.FORMAT_JSON)])
+        levels = results.create_levels([[(1, 2), (3, 4)]])
+        sent = results.send_results(7, {m.FIELD_TIMESTAMP: 1.5}, levels, srv,
+                                    pub)
+        self.assertEqual(set(sent), {(m.LEVEL_SUMMARY, m.FORMAT_JSON),
+                                     (m.LEVEL_CORNERS, m.FORMAT_BINARY)})
+        self.assertEqual(srv.sent, [sent])
+        self.assertEqual(pub.sent, [sent])
+
+        summary = m.parse_message(
+            sent[m.LEVEL_SUMMARY, m.FORMAT_JSON].decode('utf-8'))
+        self.assertEqual(summary[m.FIELD_SEQ], 7)
+        self.assertEqual(summary[m.FIELD_TIMESTAMP], 1.5)
+        self.assertEqual(summary[m.FIELD_CORNERS], [[[1, 2], [3, 4]]])
+        corners = m.parse_binary_message(sent[m.LEVEL_CORNERS, m.FORMAT_BINARY])
+        self.assertEqual(corners[m.FIELD_SEQ], 7)
+        self.assertEqual(corners[m.FIELD_CORNERS], [[[1, 2], [3, 4]]])
+
+        self.assertEqual(results.send_results(8, {}, levels,
+                                              RecordingSink([])), {})
+
+class PublishPolicyTests(unittest.TestCase):
+    """
+    Tests for deciding which results to send with policy.PublishPolicy
+    """
+
+    def test_changes(self):
+        """Test that results are only sent again when they change by more
+        than the tolerance or the keepalive time passes."""
+        now = [0]
+        pol = policy.PublishPolicy(tolerance=2, keepalive=1,
+                                   clock=lambda: now[0])
+        corners = [[(10, 10), (20, 10), (20, 20), (10, 20)]]
+        self.assertTrue(pol.should_publish(corners))
+        self.assertFalse(pol.should_publish(corners))
+        self.assertFalse(pol.should_publish(
+            [[(12, 10), (20, 9), (20, 20), (10, 20)]]))
+        self.assertTrue(pol.should_publish(
+            [[(13, 10), (20, 10), (20, 20), (10, 20)]]))
+        self.assertTrue(pol.should_publish(corners + corners))
+
+        now[0] = 0.5
+        self.assertFalse(pol.should_publish(corners + corners))
+        now[0] = 1.5
+        self.assertTrue(pol.should_publish(corners + corners))
+        self.assertEqual((pol.sent, pol.suppressed), (4, 3))
+
+    def test_lost(self):
+        """Test that losing the target is sent straight away and then kept
+        alive, and that finding it again is sent straight away."""
+        now = [0]
+        pol = policy.PublishPolicy(tolerance=2, keepalive=1,
+                                   clock=lambda: now[0])
+        corners = [[(10, 10), (20, 10), (20, 20), (10, 20)]]
+        self.assertTrue(pol.should_publish(corners))
+        self.assertTrue(pol.should_publish([]))
+        now[0] = 0.5
+        self.assertFalse(pol.should_publish([]))
+        now[0] = 1
+        self.assertTrue(pol.should_publish([]))
+        self.assertTrue(pol.should_publish(corners))
+        self.assertEqual((pol.sent, pol.suppressed), (4, 1))
+
+class MetricsTests(unittest.TestCase):
+    """
+    Tests for collecting and serving metrics with metrics.Registry
+    """
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        frames = self.registry.counter('frames_total', 'Frames')
+        frames.inc(3)
+        self.registry.gauge('queue_depth', 'Queued messages',
+                            lambda: {'a:1': 2, 'b"2': 0}, 'client')
+        latency = self.registry.histogram('latency_seconds', 'Latency',
+                                          buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            latency.observe(value)
+
+    def test_expose(self):
+        """Test that metrics are written in Prometheus' text format."""
+        lines = self.registry.expose().splitlines()
+        self.assertIn('# TYPE vision_frames_total counter', lines)
+        self.assertIn('vision_frames_total 3', lines)
+        self.assertIn('vision_queue_depth{client="a:1"} 2', lines)
+        self.assertIn('vision_queue_depth{client="b\\"2"} 0', lines)
+        self.assertIn('vision_latency_seconds_bucket{le="0.1"} 2', lines)
+        self.assertIn('vision_latency_seconds_bucket{le="1"} 3', lines)
+        self.assertIn('vision_latency_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('vision_latency_seconds_count 4', lines)
+        self.assertRaises(ValueError, self.registry.counter, 'frames_total',
+                          'Frames again')
+
+    def test_frame_metrics(self):
+        """Test that the metrics of the frames captured and processed are
+        added and read from the capture."""
+        capture = SimpleNamespace(pulled=10, dropped=2)
+        frames = metrics.add_frame_metrics(capture, self.registry)
+        frames.processed.inc(4)
+        frames.detected.inc(3)
+        frames.latency.observe(0.02)
+        values = self.registry.collect()
+        self.assertEqual(values['vision_frames_captured_total'], 10)
+        self.assertEqual(values['vision_frames_dropped_total'], 2)
+        self.assertEqual(values['vision_detection_rate'], 0.75)
+        self.assertEqual(
+            values['vision_processing_latency_seconds']['count'], 1)
+
+    def test_serve(self):
+        """Test that metrics are served over HTTP and sent in reply to
+        stats messages."""
+        srv = metrics.MetricsServer(self.registry, '127.0.0.1', 0)
+        srv.start()
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(srv.port)
+            with urlopen(url, timeout=2) as response:
+                self.assertIn(b'vision_frames_total 3', response.read())
+        finally:
+            srv.stop()
+            srv.join()
+
+        ours, theirs = socket.socketpair()
+        with ours, theirs:
+            handler = create_gst_handler(None, metrics=self.registry.collect)
+            handler(ours, m.create_message(m.TYPE_STATS, {}))
+            theirs.settimeout(2)
+            reply = json.loads(theirs.recv(65536).decode('utf-8'))
+            values = reply[m.FIELD_METRICS]
+            self.assertEqual(values['vision_frames_total'], 3)
+            self.assertEqual(values['vision_latency_seconds']['count'], 4)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)